@@ -1,28 +1,10 @@
-import os
-from openai import AzureOpenAI
-from cosmosdb import create_cosmos_client
 import time
+from clients import get_openai_client, get_retriever
+from embedding_cache import embed_text
+from retrieval import is_relevant
 from functions import pdf_to_json, docx_to_json, txt_to_json
 import json
 
-cosmos_client = create_cosmos_client()
-
-database_name = os.getenv("COSMOS_DATABASE")
-container_name = os.getenv("COSMOS_CONTAINER")
-
-database = cosmos_client.get_database_client(database_name)
-container = database.get_container_client(container_name)
-
-api_key = os.getenv("AZURE_API_KEY")
-api_version = os.getenv("AZURE_API_VERSION")
-azure_endpoint = os.getenv("AZURE_ENDPOINT")
-
-client = AzureOpenAI(
-    api_key=api_key,
-    api_version=api_version,
-    azure_endpoint=azure_endpoint
-)
-
 PROMPT_TEMPLATE = """
                 You are “PolicyPro”, an internal policy and guideline professional that answers questions based only on the provided documents.
 
@@ -195,55 +177,22 @@ while True:
             print(f"Your file: {filename}\n")
             continue
 
-        # Seivataan input_doc.jsoniksi
-        with open("input_doc.json", "w", encoding="utf-8") as f:
-            json.dump(json_data, f, ensure_ascii=False, indent=2)
-        print(f"✅ Saved to input_doc.json")
-        
-        input_doc = "input_doc.json"
+        doc = json_data
         
         try:
-            with open(input_doc, "r", encoding="utf-8") as f:
-                doc = json.load(f)
-                
-                text_to_embed = f"{doc['id']}\n\n{doc['content']}"
-                
-                response = client.embeddings.create(
-                model="text-embedding-ada-002",
-                input=text_to_embed
-                )
-                
-                embedding_vector = response.data[0].embedding
+            text_to_embed = f"{doc['id']}\n\n{doc['content']}"
+            
+            embedding_vector = embed_text(get_openai_client(), text_to_embed)
                     
         except Exception as e:
                     print("Request failed with error:", e)
                     
-        query = f"""
-                SELECT TOP {TOP_K}
-                    c.id,
-                    c.title,
-                    c.content,
-                    c.source,
-                    c.originalSource,
-                    VectorDistance(c.embedding, @q) AS score
-                FROM c
-                ORDER BY VectorDistance(c.embedding, @q)
-                """
-
-        parameters = [
-            { "name": "@q", "value": embedding_vector }
-        ]
-
-        results = list(container.query_items(
-            query=query,
-            parameters=parameters,
-            enable_cross_partition_query=True
-        ))
+        results = get_retriever().search(embedding_vector, TOP_K, query_text=text_to_embed)
         
 
         filtered_results = [
             r for r in results
-            if r["score"] >= RELEVANCE_THRESHOLD
+            if is_relevant(r, RELEVANCE_THRESHOLD)
         ]
         
         if not filtered_results:
@@ -265,7 +214,7 @@ while True:
         sources = list(dict.fromkeys(doc["source"] for doc in retrieved_docs))
                     
         try:
-            response = client.responses.create(
+            response = get_openai_client().responses.create(
                     model=MODEL_NAME,
                     input=build_doc_prompt(doc['content'], retrieved_docs),
                     temperature=0.1,
@@ -300,38 +249,13 @@ while True:
         
         try:
             start = time.time()
-            response = client.embeddings.create(
-                model="text-embedding-ada-002",
-                input=user_input
-            )
+            query_embedding = embed_text(get_openai_client(), user_input)
             
-            query_embedding = response.data[0].embedding
-            
-            query = f"""
-                SELECT TOP {TOP_K}
-                    c.id,
-                    c.title,
-                    c.content,
-                    c.source,
-                    c.originalSource,
-                    VectorDistance(c.embedding, @q) AS score
-                FROM c
-                ORDER BY VectorDistance(c.embedding, @q)
-                """
-
-            parameters = [
-                { "name": "@q", "value": query_embedding }
-            ]
-
-            results = list(container.query_items(
-                query=query,
-                parameters=parameters,
-                enable_cross_partition_query=True
-            ))
+            results = get_retriever().search(query_embedding, TOP_K, query_text=user_input)
 
             filtered_results = [
                 r for r in results
-                if r["score"] >= RELEVANCE_THRESHOLD
+                if is_relevant(r, RELEVANCE_THRESHOLD)
             ]
             
             if not filtered_results:
@@ -353,7 +277,7 @@ while True:
             sources = list(dict.fromkeys(doc["source"] for doc in retrieved_docs))
                 
             try:
-                response = client.responses.create(
+                response = get_openai_client().responses.create(
                     model=MODEL_NAME,
                     input=build_prompt(user_input, retrieved_docs),
                     temperature=0.1,
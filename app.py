@@ -1,28 +1,62 @@
-import streamlit as st
 import os
-import json
-import tempfile
-from pathlib import Path
+import uuid
+import queue
+import streamlit as st
+from io import BytesIO
 #from dotenv import load_dotenv
-from openai import AzureOpenAI
-import pdfplumber
-from docx import Document
-from document_check import doc_function
-from chat import chat_function
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from document_check import stream_doc
+from chat import stream_chat
+from tracing import start_metrics_server
+from rate_limit import session_scope
 #load_dotenv()
 
-# Alusta Azure OpenAI client
+# Prometheus-metriikat (/metrics) käynnistetään kerran, vaikka Streamlit ajaa skriptin uudelleen
 @st.cache_resource
-def get_azure_client():
-    api_key = os.getenv("AZURE_API_KEY")
-    api_version = os.getenv("AZURE_API_VERSION")
-    azure_endpoint = os.getenv("AZURE_ENDPOINT")
-    
-    return AzureOpenAI(
-        api_key=api_key,
-        api_version=api_version,
-        azure_endpoint=azure_endpoint
-    )
+def metrics_server():
+    return start_metrics_server()
+
+if os.getenv("METRICS_PORT"):
+    metrics_server()
+
+# Dokumentteja analysoidaan rinnakkain enintään tämän verran kerrallaan (jaettu rate_limit-budjetti rajaa lisäksi)
+DOC_WORKERS = int(os.getenv("APP_DOC_WORKERS", "3"))
+
+def file_key(uploaded_file):
+    # file_id on yksilöllinen myös samannimisille ja -kokoisille tiedostoille
+    return uploaded_file.file_id
+
+# Ajetaan työsäikeessä, joten tässä ei kutsuta Streamlitia; aloitus (None) ja tekstipalat
+# välitetään updates-jonon kautta pääsäikeelle, joka striimaa ne tiedoston tilalaatikkoon
+def analyze_file(key, name, data, session_id, updates):
+    updates.put((key, None))
+    result = {"response": "", "sources": [], "usage": None}
+    with session_scope(session_id):
+        for event in stream_doc(BytesIO(data), name):
+            if event["type"] == "delta":
+                updates.put((key, event["text"]))
+            else:
+                result = event
+    return result
+
+def result_state(result):
+    if result.get("busy") or result["response"].startswith(("Error:", "❌ Error:")):
+        return "error"
+    return "complete"
+
+def render_result(result):
+    st.markdown(result["response"])
+    if result["sources"]:
+        st.markdown("#### :books: Sources")
+        st.write(", ".join(result["sources"]))
+
+# Välittää tekstipalat st.write_stream:lle ja tallentaa lopun lähteet ja käytön
+def stream_text(events, final):
+    for event in events:
+        if event["type"] == "delta":
+            yield event["text"]
+        else:
+            final.update(event)
 
 # Sivun asetukset
 st.set_page_config(
@@ -33,6 +67,10 @@ st.set_page_config(
 
 st.title("📄 Policy and Guideline Agent")
 
+# Istunnon tunniste, jonka mukaan Azure-kutsujen jonotus jaetaan reilusti käyttäjien kesken
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
 # Luo kaksi saraketta pääasettelulle
 col1, col2 = st.columns([1, 1])
 
@@ -41,34 +79,85 @@ with col1:
     st.header("🔄 Guideline and Compliance Checker")
     st.write("Upload PDF or DOCX files to check compliance and get improvement suggestions.")
     
-    uploaded_file = st.file_uploader(
+    uploaded_files = st.file_uploader(
         "Drag and drop files here",
         type=["pdf", "docx", "txt", "json"],
-        accept_multiple_files=False
+        accept_multiple_files=True
     )
     
-    if uploaded_file is not None and uploaded_file.name != st.session_state.get("last_file", None):
-        # Save uploaded file to temporary location
-        st.session_state.last_file = uploaded_file.name
-        file_type = uploaded_file.name.split('.')[-1].lower()
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{file_type}") as tmp:
-            tmp.write(uploaded_file.getvalue())
-            tmp_path = tmp.name
+    # Valmiit tulokset säilytetään istunnossa, jolloin uudelleenajo ei analysoi tiedostoja uudestaan
+    results = st.session_state.setdefault("doc_results", {})
+    
+    if uploaded_files:
+        st.markdown("### :page_facing_up: Compliance Evaluation")
         
-        try:
-            with st.spinner('🔍 Analyzing document...'):
-                result = doc_function(tmp_path)
-            
-            st.markdown("### :page_facing_up: Compliance Evaluation")
-            st.markdown(result["response"])
-            if result["sources"]:
-                st.markdown("#### :books: Sources")
-                st.write(", ".join(result["sources"]))
-        except Exception as e:
-            st.error(f"❌ Error: {str(e)}")
-        finally:
-            # Clean up temp file
-            os.unlink(tmp_path)
+        # Jokaiselle tiedostolle oma tilalaatikko; uudet tiedostot jäävät jonoon analysoitaviksi
+        pending = {}
+        for uploaded_file in uploaded_files:
+            key = file_key(uploaded_file)
+            if key in results:
+                with st.status(uploaded_file.name, state=result_state(results[key]), expanded=False):
+                    render_result(results[key])
+            else:
+                status = st.status(f"⏳ {uploaded_file.name} (queued)", state="running", expanded=False)
+                pending[key] = (uploaded_file, status, status.empty())
+        
+        if pending:
+            progress = st.progress(0.0, text=f"Analyzing {len(pending)} documents...")
+            updates = queue.Queue()
+            texts = {key: "" for key in pending}
+            executor = ThreadPoolExecutor(max_workers=min(DOC_WORKERS, len(pending)))
+            try:
+                # Tiedosto käsitellään muistissa, ei väliaikaistiedostoja
+                futures = {
+                    executor.submit(analyze_file, key, uploaded_file.name, uploaded_file.getvalue(), st.session_state.session_id, updates): key
+                    for key, (uploaded_file, _, _) in pending.items()
+                }
+                completed = 0
+                running = set(futures)
+                while running:
+                    finished, running = wait(running, timeout=0.1, return_when=FIRST_COMPLETED)
+                    
+                    # Valmiit tulokset tallennetaan istuntoon ennen yhtään st.*-kutsua, jotta uudelleenajo
+                    # tai poikkeus kesken piirtämisen ei hukkaa niitä. Ruuhkan tai virheen takia
+                    # epäonnistunut tiedosto analysoidaan uudelleen seuraavalla ajolla.
+                    finished_results = {}
+                    for future in finished:
+                        key = futures[future]
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            result = {"response": f"❌ Error: {str(e)}", "sources": [], "usage": None}
+                        if result_state(result) == "complete":
+                            results[key] = result
+                        finished_results[key] = result
+                    
+                    # Työsäikeet eivät saa kutsua Streamlitia, joten tilat ja teksti päivitetään täältä.
+                    # Jono tyhjennetään ennen valmistuneiden käsittelyä, jolloin niiden kaikki palat on jo luettu.
+                    changed = set()
+                    while not updates.empty():
+                        key, text = updates.get()
+                        uploaded_file, status, placeholder = pending[key]
+                        if text is None:
+                            status.update(label=f"🔍 {uploaded_file.name} (analyzing)", expanded=True)
+                        else:
+                            texts[key] += text
+                            changed.add(key)
+                    for key in changed:
+                        pending[key][2].markdown(texts[key])
+                    
+                    # Tulos näytetään heti kun tiedosto valmistuu
+                    for key, result in finished_results.items():
+                        uploaded_file, status, placeholder = pending[key]
+                        placeholder.empty()
+                        with status:
+                            render_result(result)
+                        status.update(label=uploaded_file.name, state=result_state(result), expanded=len(pending) == 1)
+                        completed += 1
+                        progress.progress(completed / len(pending), text=f"Analyzed {completed}/{len(pending)} documents")
+            finally:
+                # Uudelleenajo keskeyttää skriptin; jonossa olevat perutaan eikä keskeneräisiä jäädä odottamaan
+                executor.shutdown(wait=False, cancel_futures=True)
             
 @st.fragment
 def chat_section():
@@ -92,13 +181,11 @@ def chat_section():
         
         # Hae AI-vastaus
         try:
-            result = chat_function(prompt)
-            
-            
+            result = {}
             
-            # Näytä avustajan vastaus
-            with st.chat_message("assistant"):
-                st.markdown(result["response"])
+            # Näytä avustajan vastaus sitä mukaa kun se syntyy
+            with st.chat_message("assistant"), session_scope(st.session_state.session_id):
+                st.write_stream(stream_text(stream_chat(prompt), result))
                 if result["sources"]:
                     st.markdown("#### :books: Sources")
                     st.write(", ".join(result["sources"]))
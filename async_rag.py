@@ -0,0 +1,226 @@
+import time
+import asyncio
+from contextlib import aclosing
+from clients import get_async_clients, get_keyword_index
+from embedding_cache import EMBEDDING_MODEL, EMBED_REQUEST_SIZE, get_cache
+from partitioning import partition_scope
+from document_store import document_query, get_document_cache
+from retrieval import DEFAULT_FILTERS, RELEVANCE_THRESHOLD, RETRIEVAL_HYBRID, is_relevant, merge_top_k, rank_score, vector_query
+from chat import build_prompt
+from prompt_cache import record_usage
+from tracing import GenerationTimer, record, traced_astream
+from rate_limit import BusyError, acreate_embeddings, acreate_response, admitted_astream, aquery_items, busy_events
+from context_packing import CONTEXT_CANDIDATES, pack_context
+from document_check import build_doc_prompt, load_document_text
+
+MODEL_NAME = "gpt-4.1"
+TOP_K = CONTEXT_CANDIDATES
+
+async def aembed_texts(texts, model=EMBEDDING_MODEL):
+    clients = get_async_clients()
+    cache = get_cache()
+    start = time.perf_counter()
+    vectors = await asyncio.to_thread(cache.get_many, model, texts)
+
+    missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+    batches = [missing[i:i + EMBED_REQUEST_SIZE] for i in range(0, len(missing), EMBED_REQUEST_SIZE)]
+    responses = await asyncio.gather(*[
+        acreate_embeddings(clients.openai, model, batch)
+        for batch in batches
+    ])
+
+    embedded = {}
+    for batch, response in zip(batches, responses):
+        batch_vectors = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        await asyncio.to_thread(cache.put_many, model, batch, batch_vectors)
+        embedded.update(zip(batch, batch_vectors))
+
+    record("embed", time.perf_counter() - start, texts=len(texts), cache_misses=len(missing))
+    return [
+        vector if vector is not None else embedded[text]
+        for text, vector in zip(texts, vectors)
+    ]
+
+async def avector_search(query_embedding, top_k, filters=None):
+    clients = get_async_clients()
+    if clients.local_retriever is not None:
+        return await asyncio.to_thread(clients.local_retriever.search, query_embedding, top_k, None, filters)
+
+    start = time.perf_counter()
+    charges = []
+    query, parameters = vector_query(query_embedding, top_k, filters)
+    scope = partition_scope(filters)
+    if scope is not None:
+        targets = [{ "partition_key": value } for value in scope]
+    else:
+        if clients.feed_ranges is None:
+            clients.feed_ranges = [feed_range async for feed_range in clients.container.read_feed_ranges()]
+        targets = [{ "feed_range": feed_range } for feed_range in clients.feed_ranges]
+
+    async def run(target):
+        return await aquery_items(
+            clients.container,
+            charges,
+            query=query,
+            parameters=parameters,
+            **target
+        )
+
+    results = merge_top_k(await asyncio.gather(*[run(target) for target in targets]), top_k)
+
+    documents = get_document_cache()
+    parent_doc_ids = documents.missing(results)
+    documents.count(results, parent_doc_ids)
+    if parent_doc_ids:
+        query, parameters = document_query(parent_doc_ids)
+        documents.update(await aquery_items(clients.container, charges, query=query, parameters=parameters))
+
+    record(
+        "retrieve",
+        time.perf_counter() - start,
+        backend="cosmos",
+        partitions=len(targets),
+        results=len(results),
+        request_charge=sum(charges)
+    )
+    return documents.attach(results)
+
+async def asearch(query_embedding, top_k=TOP_K, query_text=None, filters=None):
+    if not (RETRIEVAL_HYBRID and query_text):
+        return await avector_search(query_embedding, top_k, filters)
+
+    from keyword_index import HYBRID_CANDIDATES, reciprocal_rank_fusion
+
+    candidates = max(top_k, HYBRID_CANDIDATES)
+    vector_results = await avector_search(query_embedding, candidates, filters)
+    keyword_results = [
+        dict(r, keyword_rank=rank)
+        for rank, r in enumerate(get_keyword_index().search(query_text, candidates, filters), start=1)
+    ]
+    return reciprocal_rank_fusion([vector_results, keyword_results], top_k)
+
+async def aretrieve(queries, top_k=TOP_K, threshold=RELEVANCE_THRESHOLD, filters=None):
+    # Kaikki (ali)kyselyt upotetaan yhdellä kutsulla ja haetaan rinnakkain
+    filters = {**DEFAULT_FILTERS, **(filters or {})}
+    embeddings = await aembed_texts(queries)
+    result_lists = await asyncio.gather(*[
+        asearch(embedding, top_k, query, filters)
+        for embedding, query in zip(embeddings, queries)
+    ])
+
+    merged = {}
+    for results in result_lists:
+        for r in results:
+            if is_relevant(r, threshold) and (r["id"] not in merged or rank_score(r) > rank_score(merged[r["id"]])):
+                merged[r["id"]] = r
+    return sorted(merged.values(), key=rank_score, reverse=True)
+
+async def agenerate(prompt, prompt_name):
+    clients = get_async_clients()
+    timer = GenerationTimer(prompt_name)
+    response = await acreate_response(
+        clients.openai,
+        model=MODEL_NAME,
+        input=prompt,
+        temperature=0.1,
+        max_output_tokens=1000,
+        prompt_cache_key=prompt_name,
+        stream=True
+    )
+
+    async for event in response:
+        if event.type == "response.output_text.delta":
+            timer.delta()
+            yield {"type": "delta", "text": event.delta}
+        if event.type == "response.completed":
+            usage = record_usage(prompt_name, event.response.usage)
+            timer.done(usage)
+            yield {"type": "usage", "usage": usage}
+
+async def astream_answer(prompt, prompt_name, filtered_results, context=None):
+    sources = list(dict.fromkeys(r["source"] for r in filtered_results))
+    assistant_response = ""
+    usage = None
+    busy = False
+    try:
+        async with aclosing(agenerate(prompt, prompt_name)) as events:
+            async for event in events:
+                if event["type"] == "usage":
+                    usage = event["usage"]
+                    continue
+                assistant_response += event["text"]
+                yield event
+    except BusyError as e:
+        busy = True
+        assistant_response = str(e)
+        yield {"type": "delta", "text": assistant_response}
+    except Exception as e:
+        print("Request failed with error:", e)
+        assistant_response = f"Error: {str(e)}"
+        yield {"type": "delta", "text": assistant_response}
+
+    yield {
+        "type": "done",
+        "response": assistant_response,
+        "sources": sources,
+        "usage": usage,
+        "context": context,
+        "busy": busy
+    }
+
+@traced_astream("chat")
+@admitted_astream
+async def astream_chat(user_input, sub_queries=(), filters=None):
+    try:
+        filtered_results, context = pack_context(await aretrieve([user_input, *sub_queries], filters=filters), user_input)
+    except BusyError as e:
+        for event in busy_events(e):
+            yield event
+        return
+    except Exception as e:
+        print("Request failed with error:", e)
+        yield {"type": "delta", "text": f"Error: {str(e)}"}
+        yield {"type": "done", "response": f"Error: {str(e)}", "sources": [], "usage": None}
+        return
+
+    async with aclosing(astream_answer(build_prompt(user_input, filtered_results), "chat", filtered_results, context)) as events:
+        async for event in events:
+            yield event
+
+@traced_astream("doc")
+@admitted_astream
+async def astream_doc(source, filename=None, filters=None):
+    try:
+        text_to_embed = await asyncio.to_thread(load_document_text, source, filename)
+        filtered_results, context = pack_context(await aretrieve([text_to_embed[:8000]], filters=filters), text_to_embed[:8000])
+    except BusyError as e:
+        for event in busy_events(e):
+            yield event
+        return
+    except Exception as e:
+        print("Request failed with error:", e)
+        yield {"type": "delta", "text": f"Error: {str(e)}"}
+        yield {"type": "done", "response": f"Error: {str(e)}", "sources": [], "usage": None}
+        return
+
+    async with aclosing(astream_answer(build_doc_prompt(text_to_embed, filtered_results), "doc", filtered_results, context)) as events:
+        async for event in events:
+            yield event
+
+async def collect(events):
+    # aclosing sulkee generaattorin tässä tehtävässä, jolloin trace ja pääsynvalvonnan paikka vapautuvat heti
+    async with aclosing(events):
+        async for event in events:
+            if event["type"] == "done":
+                return {
+                    "response": event["response"],
+                    "sources": event["sources"],
+                    "usage": event["usage"],
+                    "busy": event.get("busy", False)
+                }
+
+async def achat_function(user_input, sub_queries=(), filters=None):
+    return await collect(astream_chat(user_input, sub_queries, filters))
+
+async def adoc_function(source, filename=None, filters=None):
+    return await collect(astream_doc(source, filename, filters))
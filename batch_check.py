@@ -0,0 +1,157 @@
+import os
+import glob
+import json
+import time
+import argparse
+from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from document_check import CONVERTERS, doc_function
+from rate_limit import session_scope
+
+# Eräajona tehtävä vaatimustenmukaisuustarkistus: kansio tai glob-lauseke käydään läpi
+# doc_functionilla rajatulla rinnakkaisuudella ja jokaisesta tiedostosta kirjoitetaan yksi
+# JSONL-rivi. Tulostiedosto toimii samalla tarkistuspisteenä: keskeytetty ajo jatkuu
+# tiedostoista, joilla ei vielä ole valmista tulosta.
+# Käyttö: python batch_check.py <kansio|glob> [--output batch_results.jsonl] [--workers 4] [--retry-failed]
+BATCH_RESULTS = os.getenv("BATCH_RESULTS", "batch_results.jsonl")
+# Pidetään pienempänä kuin MAX_ACTIVE_REQUESTS, jotta interaktiivisille käyttäjille jää tilaa
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))
+# Ruuhkan takia hylätty tiedosto yritetään uudelleen näin monta kertaa
+BATCH_BUSY_RETRIES = 3
+BATCH_BUSY_DELAY = 10.0
+# Eräajon pyynnöt jonottavat omana istuntonaan, jolloin reilu jonotus suosii interaktiivisia käyttäjiä
+BATCH_SESSION = "batch"
+
+def list_files(target):
+    path = Path(target)
+    if path.is_dir():
+        files = (file for file in path.rglob("*") if file.is_file())
+    else:
+        files = (Path(file) for file in glob.glob(target, recursive=True) if os.path.isfile(file))
+    return sorted(str(file) for file in files if file.suffix.lower().lstrip(".") in CONVERTERS)
+
+def fingerprint(path):
+    # Muuttunut tiedosto tarkistetaan uudelleen, vaikka sille olisi jo tulos
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+def load_checkpoint(path, retry_failed=False):
+    # Keskeytetyn ajon viimeinen rivi voi olla vajaa, joten rikkinäiset rivit ohitetaan
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if result["status"] == "ok" or (result["status"] == "error" and not retry_failed):
+                done[result["path"]] = result["fingerprint"]
+            else:
+                done.pop(result["path"], None)
+    return done
+
+def ends_with_newline(path):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return True
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+def check_file(path, map_reduce=None):
+    start = time.perf_counter()
+    attempts = 0
+    with session_scope(BATCH_SESSION):
+        while True:
+            attempts += 1
+            try:
+                result = doc_function(path, map_reduce=map_reduce)
+            except Exception as e:
+                result = {"response": f"Error: {str(e)}", "sources": [], "usage": None}
+            if not result.get("busy") or attempts > BATCH_BUSY_RETRIES:
+                break
+            time.sleep(BATCH_BUSY_DELAY * attempts)
+
+    if result.get("busy"):
+        status = "busy"
+    elif result["response"].startswith("Error:"):
+        status = "error"
+    else:
+        status = "ok"
+    return {
+        "path": path,
+        "fingerprint": fingerprint(path),
+        "status": status,
+        "response": result["response"],
+        "sources": result["sources"],
+        "usage": result["usage"],
+        "attempts": attempts,
+        "seconds": round(time.perf_counter() - start, 3),
+        "finished": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+
+def run_batch(files, output=BATCH_RESULTS, workers=BATCH_WORKERS, map_reduce=None, retry_failed=False):
+    done = load_checkpoint(output, retry_failed)
+    pending = [path for path in files if done.get(path) != fingerprint(path)]
+    stats = {"files": len(files), "skipped": len(files) - len(pending), "ok": 0, "error": 0, "busy": 0, "input_tokens": 0, "output_tokens": 0}
+    print(f"{len(files)} files, {stats['skipped']} already checked, {len(pending)} to go")
+
+    start = time.perf_counter()
+    queue = iter(pending)
+    running = set()
+    # Tehtäviä annetaan vain muutama kerrallaan, jotta 10k tiedoston ajo ei luo kaikkia futureja etukäteen
+    with open(output, "a", encoding="utf-8") as f, ThreadPoolExecutor(max_workers=workers) as executor:
+        if not ends_with_newline(output):
+            # Vajaa rivi suljetaan, ettei seuraava tulos liity sen perään
+            f.write("\n")
+        try:
+            while True:
+                for path in queue:
+                    running.add(executor.submit(check_file, path, map_reduce))
+                    if len(running) >= workers * 2:
+                        break
+                if not running:
+                    break
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    result = future.result()
+                    f.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    f.flush()
+                    stats[result["status"]] += 1
+                    for key in ("input_tokens", "output_tokens"):
+                        stats[key] += (result["usage"] or {}).get(key, 0)
+                    completed = stats["ok"] + stats["error"] + stats["busy"]
+                    print(f"[{completed}/{len(pending)}] {result['status']:<5} {result['seconds']:>7.1f}s {result['path']}")
+        except KeyboardInterrupt:
+            # Valmiit tulokset on jo kirjoitettu; seuraava ajo jatkaa tästä
+            executor.shutdown(wait=False, cancel_futures=True)
+            print("\nInterrupted, rerun the same command to resume")
+            raise
+
+    stats["seconds"] = time.perf_counter() - start
+    completed = stats["ok"] + stats["error"] + stats["busy"]
+    stats["files_per_min"] = completed / stats["seconds"] * 60 if stats["seconds"] > 0 else 0.0
+    return stats
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Batch compliance check with resumable JSONL results")
+    parser.add_argument("target", help="folder (searched recursively) or glob pattern")
+    parser.add_argument("--output", default=BATCH_RESULTS)
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS)
+    parser.add_argument("--map-reduce", choices=["auto", "on", "off"], default="auto")
+    parser.add_argument("--retry-failed", action="store_true", help="check files whose previous result was an error")
+    args = parser.parse_args()
+
+    files = list_files(args.target)
+    map_reduce = {"auto": None, "on": True, "off": False}[args.map_reduce]
+    try:
+        stats = run_batch(files, args.output, args.workers, map_reduce, args.retry_failed)
+    except KeyboardInterrupt:
+        raise SystemExit(130)
+    print(
+        f"\nDone: {stats['ok']} ok, {stats['error']} errors, {stats['busy']} busy, {stats['skipped']} skipped "
+        f"in {stats['seconds']:.1f}s ({stats['files_per_min']:.1f} files/min), "
+        f"{stats['input_tokens']} input / {stats['output_tokens']} output tokens -> {args.output}"
+    )
@@ -0,0 +1,320 @@
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Offline-benchmark: Azure OpenAI ja Cosmos korvataan fakes.py:n paikallisilla versioilla,
+# jolloin ingestion, chat_functionin, doc_functionin ja rinnakkaisten istuntojen suorituskykyä
+# voi verrata committien välillä. Tulokset lisätään BENCHMARK_RESULTS-tiedostoon rivi per ajo.
+# Käyttö: python benchmark.py [--scenarios ingest,chat,doc,load,burst] [--compare] [--latency-scale 0]
+
+# Välimuistit ja tracet väliaikaiseen hakemistoon, jotta ajot eivät vaikuta toisiinsa
+WORK_DIR = tempfile.mkdtemp(prefix="rag-benchmark-")
+os.environ.setdefault("EMBEDDING_CACHE_PATH", os.path.join(WORK_DIR, "embedding_cache.sqlite3"))
+os.environ.setdefault("TRACE_PATH", os.path.join(WORK_DIR, "traces.jsonl"))
+os.environ.setdefault("KEYWORD_INDEX_PATH", os.path.join(WORK_DIR, "keyword_index.pkl"))
+os.environ["RETRIEVAL_BACKEND"] = "cosmos"
+# Fake-palveluilla ei ole kiintiöitä; rate_limit.py:n budjetit nostetaan, ettei ajo mittaa niitä (voi ohittaa ympäristöstä)
+os.environ.setdefault("OPENAI_RPM", "1000000")
+os.environ.setdefault("OPENAI_TPM", "1000000000")
+os.environ.setdefault("COSMOS_RU_PER_SEC", "1000000")
+
+import clients
+from fakes import FakeContainer, FakeEmbeddings, FakeOpenAI, FakeResponses
+from partitioning import COSMOS_PARTITION_KEY
+from tracing import percentile
+
+BENCHMARK_RESULTS = os.getenv("BENCHMARK_RESULTS", "benchmark_results.jsonl")
+SCENARIOS = ["ingest", "chat", "doc", "load", "burst"]
+
+COMPANIES = ["NordSure", "Baltic Mutual", "Fjord Bank", "Aurora Life"]
+DOCUMENT_TYPES = ["policy", "guideline", "procedure", "terms"]
+TOPICS = [
+    "travel expenses", "claims handling", "data retention", "customer complaints", "anti money laundering",
+    "remote work", "vendor onboarding", "incident reporting", "gift policy", "password rotation",
+    "loan approval", "conflict of interest", "marketing consent", "fraud escalation", "record keeping"
+]
+WORDS = (
+    "must should approve submit within days manager compliance report record customer employee "
+    "document evidence review escalate limit deadline notify retain archive verify request exception "
+    "audit risk owner quarterly annual signed receipt threshold amount register process team"
+).split()
+
+def sentence(rng, topic):
+    words = rng.sample(WORDS, 8)
+    return f"{topic.capitalize()} {' '.join(words)} within {rng.randint(2, 90)} days."
+
+def make_corpus(count, seed=7):
+    rng = random.Random(seed)
+    docs = []
+    for i in range(count):
+        topic = TOPICS[i % len(TOPICS)]
+        paragraphs = [
+            " ".join(sentence(rng, topic) for _ in range(rng.randint(3, 6)))
+            for _ in range(rng.randint(2, 8))
+        ]
+        docs.append({
+            "id": f"DOC-{i:04d}",
+            "title": f"{topic.title()} {DOCUMENT_TYPES[i % len(DOCUMENT_TYPES)]} {i}",
+            "company": COMPANIES[i % len(COMPANIES)],
+            "documentType": DOCUMENT_TYPES[i % len(DOCUMENT_TYPES)],
+            "version": "1.0",
+            "status": "active",
+            "effectiveDate": "2025-01-01",
+            "lastUpdated": "2025-01-01",
+            "changeLog": [{"version": "1.0", "date": "2025-01-01", "changes": " ".join(rng.sample(WORDS, 12))}] * 4,
+            "source": f"{topic.replace(' ', '_')}_{i}.pdf",
+            "tags": topic.split(),
+            "content": "\n\n".join(paragraphs)
+        })
+    return docs
+
+def make_questions(count, seed=11):
+    rng = random.Random(seed)
+    return [
+        f"What is the deadline to {rng.choice(WORDS)} {TOPICS[i % len(TOPICS)]} {' '.join(rng.sample(WORDS, 3))} case {i}?"
+        for i in range(count)
+    ]
+
+def make_upload(paragraphs, seed=13):
+    rng = random.Random(seed)
+    text = "\n\n".join(
+        " ".join(sentence(rng, rng.choice(TOPICS)) for _ in range(5))
+        for _ in range(paragraphs)
+    )
+    return text.encode("utf-8")
+
+def summarize(latencies, seconds=None):
+    summary = {
+        "count": len(latencies),
+        "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000
+    }
+    if seconds:
+        summary["per_sec"] = len(latencies) / seconds
+    return summary
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+def setup(latency_scale, partitions, docs):
+    openai = FakeOpenAI(
+        FakeEmbeddings(latency_ms=20.0 * latency_scale, per_input_ms=0.5 * latency_scale),
+        FakeResponses(ttft_ms=150.0 * latency_scale, token_ms=2.0 * latency_scale)
+    )
+    container = FakeContainer(COSMOS_PARTITION_KEY, physical_partitions=partitions, latency_ms=5.0 * latency_scale)
+
+    from retrieval import METADATA_FIELDS, RETRIEVAL_HYBRID, get_retriever
+
+    keyword_index = None
+    if RETRIEVAL_HYBRID:
+        from cosmosdb import chunk_document
+        from document_store import document_record, join_document
+        from keyword_index import BM25Index
+
+        keyword_index = BM25Index()
+        for doc in docs:
+            record = document_record(doc)
+            keyword_index.sync_document(doc["id"], [join_document(chunk, record) for chunk in chunk_document(doc)], METADATA_FIELDS)
+        clients.set_client("keyword_index", keyword_index)
+
+    clients.set_client("openai", openai)
+    clients.set_client("container", container)
+    clients.set_client("retriever", get_retriever(container, keyword_index=keyword_index))
+    return openai, container
+
+def bench_ingest(openai, container, docs):
+    from cosmosdb import sync_documents
+
+    results = {}
+    for name in ("cold", "incremental"):
+        charge_before = container.request_charge
+        seconds, stats = timed(sync_documents, openai, container, docs)
+        results[name] = {
+            "seconds": seconds,
+            "chunks_written": stats["written"],
+            "chunks_per_sec": stats["written"] / seconds if seconds else 0.0,
+            "request_charge": container.request_charge - charge_before,
+            "throttled": stats["throttled"]
+        }
+    return results
+
+def without_answer_cache():
+    # Semanttinen välimuisti ohitetaan, jotta mitataan koko putki (kosini ei voi ylittää 1:tä)
+    import chat
+
+    chat.answer_cache.clear()
+    chat.answer_cache.threshold = 2.0
+
+def bench_chat(questions):
+    import chat
+
+    without_answer_cache()
+    latencies = [timed(chat.chat_function, question)[0] for question in questions]
+    results = {"uncached": summarize(latencies)}
+
+    chat.answer_cache.threshold = 0.95
+    for question in questions:
+        chat.chat_function(question)
+    results["cached"] = summarize([timed(chat.chat_function, question)[0] for question in questions])
+    return results
+
+def bench_doc(rounds):
+    from document_check import doc_function
+
+    results = {}
+    for name, paragraphs, map_reduce in (("single", 6, False), ("map_reduce", 60, True)):
+        upload = make_upload(paragraphs)
+        latencies = [timed(doc_function, upload, "upload.txt", map_reduce)[0] for _ in range(rounds)]
+        results[name] = summarize(latencies)
+    return results
+
+def bench_load(questions, sessions):
+    from chat import chat_function
+
+    without_answer_cache()
+    per_session = [questions[i::sessions] for i in range(sessions)]
+
+    def session(session_questions):
+        return [timed(chat_function, question)[0] for question in session_questions]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        latencies = [latency for result in executor.map(session, per_session) for latency in result]
+    return {f"{sessions}_sessions": summarize(latencies, time.perf_counter() - start)}
+
+def bench_burst(question, sessions):
+    # Kaikki istunnot kysyvät saman kysymyksen yhtä aikaa (esim. tiedotteen jälkeen)
+    from chat import chat_function
+
+    without_answer_cache()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        latencies = list(executor.map(lambda _: timed(chat_function, question)[0], range(sessions)))
+    return {f"{sessions}_sessions": summarize(latencies, time.perf_counter() - start)}
+
+def git_revision():
+    try:
+        repo = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repo, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo, capture_output=True, text=True).stdout.strip())
+    except OSError:
+        return None, False
+    return commit or None, dirty
+
+def flatten(results, prefix=""):
+    rows = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            rows.update(flatten(value, f"{prefix}{key}."))
+        else:
+            rows[f"{prefix}{key}"] = value
+    return rows
+
+def print_report(report):
+    print(f"\nBenchmark {report['commit']}{' (dirty)' if report['dirty'] else ''}, config {report['config']}")
+    for name, value in flatten(report["results"]).items():
+        print(f"  {name:<45} {value:>12.2f}")
+
+def load_reports(path=BENCHMARK_RESULTS):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def print_comparison(report, previous):
+    # Vertailu edelliseen ajoon toisesta commitista; latenssissa pienempi on parempi, läpäisyssä suurempi
+    print(f"\nCompared to {previous['commit']} ({previous['timestamp']}):")
+    old = flatten(previous["results"])
+    for name, value in flatten(report["results"]).items():
+        if name in old and old[name]:
+            change = (value - old[name]) / old[name]
+            print(f"  {name:<45} {old[name]:>12.2f} -> {value:>12.2f} ({change:+.1%})")
+
+def run(args):
+    scenarios = args.scenarios.split(",")
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise ValueError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    docs = make_corpus(args.docs)
+    openai, container = setup(args.latency_scale, args.partitions, docs)
+    questions = make_questions(args.questions)
+
+    from cosmosdb import sync_documents
+
+    results = {}
+    if "ingest" in scenarios:
+        results["ingest"] = bench_ingest(openai, container, docs)
+    else:
+        sync_documents(openai, container, docs)
+    if "chat" in scenarios:
+        results["chat"] = bench_chat(questions)
+    if "doc" in scenarios:
+        results["doc"] = bench_doc(args.doc_rounds)
+    if "load" in scenarios:
+        results["load"] = bench_load(make_questions(args.sessions * args.per_session, seed=17), args.sessions)
+    if "burst" in scenarios:
+        results["burst"] = bench_burst(make_questions(1, seed=19)[0], args.sessions)
+
+    from prompt_cache import prompt_cache_stats
+    from rate_limit import scheduler
+    from single_flight import single_flight
+
+    results["prompt_cache"] = prompt_cache_stats.stats()
+    results["scheduler"] = scheduler.stats()
+    results["single_flight"] = single_flight.stats()
+
+    commit, dirty = git_revision()
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "docs": args.docs,
+            "questions": args.questions,
+            "sessions": args.sessions,
+            "latency_scale": args.latency_scale,
+            "partitions": args.partitions,
+            "partition_key": COSMOS_PARTITION_KEY
+        },
+        "results": results
+    }
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Offline RAG benchmark against local fakes")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--docs", type=int, default=200)
+    parser.add_argument("--questions", type=int, default=30)
+    parser.add_argument("--doc-rounds", type=int, default=3)
+    parser.add_argument("--sessions", type=int, default=8)
+    parser.add_argument("--per-session", type=int, default=5)
+    parser.add_argument("--partitions", type=int, default=4)
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="0 measures only local CPU time")
+    parser.add_argument("--compare", action="store_true", help="compare with the latest run from another commit")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+
+    if args.compare:
+        previous = [r for r in load_reports() if r["commit"] != report["commit"] and r["config"] == report["config"]]
+        if previous:
+            print_comparison(report, previous[-1])
+        else:
+            print("\nNo earlier run with the same config from another commit")
+
+    if not args.no_save:
+        with open(BENCHMARK_RESULTS, "a", encoding="utf-8") as f:
+            f.write(json.dumps(report) + "\n")
+        print(f"\nSaved to {BENCHMARK_RESULTS}")
@@ -1,35 +1,20 @@
-import os
-from openai import AzureOpenAI
-from cosmosdb import create_cosmos_client
-
-
-cosmos_client = create_cosmos_client()
-
-database_name = os.getenv("COSMOS_DATABASE")
-container_name = os.getenv("COSMOS_CONTAINER")
-
-database = cosmos_client.get_database_client(database_name)
-container = database.get_container_client(container_name)
-
-api_key = os.getenv("AZURE_API_KEY")
-api_version = os.getenv("AZURE_API_VERSION")
-azure_endpoint = os.getenv("AZURE_ENDPOINT")
-
-client = AzureOpenAI(
-    api_key=api_key,
-    api_version=api_version,
-    azure_endpoint=azure_endpoint
-)
-
-PROMPT_TEMPLATE = """
+from clients import get_openai_client, get_retriever
+from context_packing import CONTEXT_CANDIDATES, format_doc, pack_context, stable_order
+from embedding_cache import embed_text
+from retrieval import DEFAULT_FILTERS, RELEVANCE_THRESHOLD, is_relevant
+from semantic_cache import SemanticCache
+from prompt_cache import minify_prompt, record_usage
+from tracing import GenerationTimer, traced_stream
+from rate_limit import BusyError, admitted_stream, create_response
+from single_flight import coalesced, normalize_question
+import json
+
+answer_cache = SemanticCache()
+
+# Staattiset ohjeet ensin, jotta kaikki kyselyt jakavat saman välimuistitettavan etuliitteen
+PROMPT_TEMPLATE = minify_prompt("""
                 You are “PolicyPro”, an internal policy and guideline professional that answers questions using the provided documents as the primary source of truth.
 
-                User question:
-                {user_input}
-
-                Relevant documents:
-                {retrieved_docs}
-
                 Core principles:
                 - Base answers on the provided documents.
                 - Do not invent, assume, or infer policies that are not explicitly stated.
@@ -76,63 +61,69 @@ PROMPT_TEMPLATE = """
                 - Respond with:
                 - **Decision:** I don’t know
                 - Briefly state that no applicable policy information was found.
-                """
+                """)
+
+PROMPT_INPUT = """
+
+Relevant documents:
+{retrieved_docs}
+
+User question:
+{user_input}
+"""
                 
 def build_prompt(user_input, docs):
-    joined_docs = "\n\n".join(
-    [
-        f"Title: {doc['title']}\n"
-        f"Content: {doc['content']}"
-        for doc in docs
-    ]
-    )
-    return PROMPT_TEMPLATE.format(
+    joined_docs = "\n\n".join(format_doc(doc) for doc in stable_order(docs))
+    return PROMPT_TEMPLATE + PROMPT_INPUT.format(
         user_input=user_input,
         retrieved_docs=joined_docs
     )
     
-def chat_function(user_input):
+def chat_flight_key(user_input, filters=None):
+    filters = {**DEFAULT_FILTERS, **(filters or {})}
+    return ("chat", normalize_question(user_input), json.dumps(filters, sort_keys=True))
+
+@coalesced(chat_flight_key)
+@traced_stream("chat")
+@admitted_stream
+def stream_chat(user_input, filters=None):
     
     MODEL_NAME = "gpt-4.1"
-    TOP_K = 3                   
-    RELEVANCE_THRESHOLD = 0.75
+    TOP_K = CONTEXT_CANDIDATES  # ylimitoitettu; pack_context rajaa kontekstin tokenibudjettiin
+
+    assistant_response = ""
+    sources = []
+    usage = None
+    context = None
+    busy = False
 
-    #user_input = input("Question: ")
+    filters = {**DEFAULT_FILTERS, **(filters or {})}
+    scope = json.dumps(filters, sort_keys=True)
 
     try:
-        response = client.embeddings.create(
-            model="text-embedding-ada-002",
-            input=user_input
-        )
+        client = get_openai_client()
+        retriever = get_retriever()
         
-        query_embedding = response.data[0].embedding
+        query_embedding = embed_text(client, user_input)
         
-        query = f"""
-            SELECT TOP {TOP_K}
-                c.id,
-                c.title,
-                c.content,
-                c.source,
-                c.originalSource,
-                VectorDistance(c.embedding, @q) AS score
-            FROM c
-            ORDER BY VectorDistance(c.embedding, @q)
-            """
-
-        parameters = [
-            { "name": "@q", "value": query_embedding }
-        ]
-
-        results = list(container.query_items(
-            query=query,
-            parameters=parameters,
-            enable_cross_partition_query=True
-        ))
+        cached = answer_cache.lookup(query_embedding, retriever.document_versions, scope)
+        if cached is not None:
+            yield {"type": "delta", "text": cached["response"]}
+            yield {
+                "type": "done",
+                "response": cached["response"],
+                "sources": cached["sources"],
+                "usage": None,
+                "cached": True
+            }
+            return
+        
+        results = retriever.search(query_embedding, TOP_K, query_text=user_input, filters=filters)
 
-        filtered_results = [
-            r for r in results
-            if r["score"] >= RELEVANCE_THRESHOLD
-        ]
+        filtered_results, context = pack_context(
+            [r for r in results if is_relevant(r, RELEVANCE_THRESHOLD)],
+            user_input
+        )
         
         if not filtered_results:
             print("\nAssistant: I don't know.")
@@ -152,43 +143,64 @@ def chat_function(user_input):
         
         sources = list(dict.fromkeys(doc["source"] for doc in retrieved_docs))
             
-        try:
-            response = client.responses.create(
-                model=MODEL_NAME,
-                input=build_prompt(user_input, retrieved_docs),
-                temperature=0.1,
-                max_output_tokens=1000,
-                stream=True
+        timer = GenerationTimer("chat")
+        response = create_response(
+            client,
+            model=MODEL_NAME,
+            input=build_prompt(user_input, retrieved_docs),
+            temperature=0.1,
+            max_output_tokens=1000,
+            prompt_cache_key="chat",
+            stream=True
+        )
+        
+        for event in response:
+                
+            if event.type == "response.output_text.delta":
+                timer.delta()
+                assistant_response += event.delta
+                yield {"type": "delta", "text": event.delta}
+                
+            if event.type == "response.completed":
+                usage = record_usage("chat", event.response.usage)
+        timer.done(usage)
+        
+        if filtered_results:
+            answer_cache.store(
+                query_embedding,
+                assistant_response,
+                sources,
+                {r["parent_doc_id"]: r["version"] for r in filtered_results},
+                scope
             )
-            
-            #print("\nAssistant:\n\n", end="")
-            
-            assistant_response = ""
-            
-            for event in response:
-                    
-                """if event.type == "response.output_text.delta":
-                    print(event.delta, end="")
-                    assistant_response += event.delta"""
-                    
-                if event.type == "response.completed":
-                    usage = event.response.usage
-                    input_tokens_used = usage.input_tokens
-                    output_tokens_used = usage.output_tokens
-            
-        except Exception as e:
-            print("Request failed with error:", e)
-            
-        #print("\n\nSources:", ", ".join(sources))
-            
-        #print("\n---\n")
+        
+    except BusyError as e:
+        busy = True
+        assistant_response = str(e)
+        yield {"type": "delta", "text": assistant_response}
         
     except Exception as e:
         print("Request failed with error:", e)
+        assistant_response = f"Error: {str(e)}"
+        yield {"type": "delta", "text": assistant_response}
         
-    assistant_response = event.response.output[0].content[0].text
-        
-    return {
+    yield {
+        "type": "done",
         "response": assistant_response,
-        "sources": sources
-    }
\ No newline at end of file
+        "sources": sources,
+        "usage": usage,
+        "context": context,
+        "cached": False,
+        "busy": busy
+    }
+
+def chat_function(user_input, filters=None):
+    
+    for event in stream_chat(user_input, filters):
+        if event["type"] == "done":
+            return {
+                "response": event["response"],
+                "sources": event["sources"],
+                "usage": event["usage"],
+                "busy": event.get("busy", False)
+            }
@@ -0,0 +1,112 @@
+import os
+import asyncio
+import threading
+import weakref
+
+# Prosessin yhteiset asiakkaat. Ne luodaan vasta ensimmäisellä käyttökerralla,
+# jotta `import app` ei avaa yhteyksiä eikä lataa openai/azure-kirjastoja ennen ensimmäistä kutsua.
+# RLock, koska tehdasfunktiot hakevat toisia asiakkaita (retriever -> container -> cosmos) lukon ollessa varattuna
+_lock = threading.RLock()
+_registry = {}
+_async_registry = weakref.WeakKeyDictionary()
+
+def _get(name, factory):
+    client = _registry.get(name)
+    if client is None:
+        with _lock:
+            client = _registry.get(name)
+            if client is None:
+                client = factory()
+                _registry[name] = client
+    return client
+
+def set_client(name, client):
+    # Korvaa asiakkaan, esim. testeissä tai benchmarkeissa paikallisella toteutuksella
+    with _lock:
+        _registry[name] = client
+
+def reset_clients():
+    with _lock:
+        _registry.clear()
+
+def _create_openai_client():
+    from openai import AzureOpenAI
+
+    # Uudelleenyritykset hoitaa rate_limit.py, joka noudattaa retry-afteria koko prosessin tasolla
+    return AzureOpenAI(
+        api_key=os.getenv("AZURE_API_KEY"),
+        api_version=os.getenv("AZURE_API_VERSION"),
+        azure_endpoint=os.getenv("AZURE_ENDPOINT"),
+        max_retries=0
+    )
+
+def _create_container():
+    from cosmosdb import create_cosmos_client
+
+    cosmos_client = _get("cosmos", create_cosmos_client)
+    database = cosmos_client.get_database_client(os.getenv("COSMOS_DATABASE"))
+    return database.get_container_client(os.getenv("COSMOS_CONTAINER"))
+
+def _create_retriever():
+    from retrieval import RETRIEVAL_BACKEND, RETRIEVAL_HYBRID, get_retriever
+
+    container = get_container() if RETRIEVAL_BACKEND == "cosmos" else None
+    keyword_index = get_keyword_index() if RETRIEVAL_HYBRID else None
+    return get_retriever(container, keyword_index=keyword_index)
+
+def _create_keyword_index():
+    from keyword_index import load_index
+
+    return load_index()
+
+def get_openai_client():
+    return _get("openai", _create_openai_client)
+
+def get_container():
+    return _get("container", _create_container)
+
+def get_retriever():
+    return _get("retriever", _create_retriever)
+
+def get_keyword_index():
+    return _get("keyword_index", _create_keyword_index)
+
+class AsyncClients:
+    def __init__(self):
+        from openai import AsyncAzureOpenAI
+        from azure.cosmos.aio import CosmosClient
+        from retrieval import RETRIEVAL_BACKEND, get_retriever as get_vector_retriever
+
+        self.openai = AsyncAzureOpenAI(
+            api_key=os.getenv("AZURE_API_KEY"),
+            api_version=os.getenv("AZURE_API_VERSION"),
+            azure_endpoint=os.getenv("AZURE_ENDPOINT"),
+            max_retries=0
+        )
+        self.cosmos = CosmosClient(os.getenv("COSMOS_ENDPOINT"), credential=os.getenv("COSMOS_KEY"))
+        self.container = (
+            self.cosmos
+            .get_database_client(os.getenv("COSMOS_DATABASE"))
+            .get_container_client(os.getenv("COSMOS_CONTAINER"))
+        )
+        self.feed_ranges = None
+        # Paikallinen indeksi on synkroninen; hybridihaku yhdistetään asearchissa erikseen
+        self.local_retriever = get_vector_retriever(backend="local", hybrid=False) if RETRIEVAL_BACKEND == "local" else None
+
+    async def close(self):
+        await self.openai.close()
+        await self.cosmos.close()
+
+def get_async_clients():
+    # Asynkroniset asiakkaat on sidottu tapahtumasilmukkaan, joten niitä pidetään silmukkakohtaisesti
+    loop = asyncio.get_running_loop()
+    clients = _async_registry.get(loop)
+    if clients is None:
+        clients = AsyncClients()
+        _async_registry[loop] = clients
+    return clients
+
+async def close_async_clients():
+    clients = _async_registry.pop(asyncio.get_running_loop(), None)
+    if clients is not None:
+        await clients.close()
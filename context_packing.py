@@ -0,0 +1,131 @@
+import os
+import re
+from tracing import span
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Haetaan ylimitoitettu ehdokasjoukko ja pakataan siitä kontekstiin mahtuva osa
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", "8"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Yksittäinen chunk lyhennetään tähän mittaan osuvimmista lauseista
+CONTEXT_CHUNK_MAX_TOKENS = int(os.getenv("CONTEXT_CHUNK_MAX_TOKENS", "800"))
+# Chunk jätetään pois, jos tämä osuus sen sanakolmikoista on jo mukana otetuissa
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))
+# Alle tämän jäävää budjettia ei kannata täyttää lyhennetyllä chunkilla
+CONTEXT_MIN_TOKENS = 40
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "o200k_base")
+# Säästö lasketaan aiempaan tapaan verrattuna: kolme parasta osumaa kokonaisina
+CONTEXT_BASELINE_TOP_K = 3
+
+_encoding = None
+
+def count_tokens(text):
+    global _encoding
+    if tiktoken is None:
+        # Karkea arvio kun tiktoken ei ole asennettu
+        return len(text) // 4 + 1
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding(CONTEXT_TOKENIZER)
+    return len(_encoding.encode(text))
+
+def format_doc(doc):
+    return f"Title: {doc['title']}\nContent: {doc['content']}"
+
+def stable_order(docs):
+    # Sama hakujoukko tuottaa aina saman tekstin, jolloin staattinen ohje ja dokumentit muodostavat
+    # yhdessä välimuistitettavan etuliitteen (pelkkä ohje jää alle 1024 tokenin minimin)
+    return sorted(docs, key=lambda doc: (doc.get("source") or "", doc.get("title") or "", doc["content"]))
+
+def split_into_sentences(text):
+    sentences = re.split(r'(?<=[.!?])\s+', text.strip())
+    return [s for s in sentences if s]
+
+def shingles(text):
+    from keyword_index import tokenize
+
+    words = tokenize(text)
+    if len(words) < 3:
+        return {tuple(words)}
+    return {tuple(words[i:i + 3]) for i in range(len(words) - 2)}
+
+def is_duplicate(candidate, packed):
+    if not candidate:
+        return False
+    return any(len(candidate & other) / len(candidate) >= CONTEXT_DEDUP_THRESHOLD for other in packed)
+
+def trim_to_budget(text, query_terms, max_tokens):
+    from keyword_index import tokenize
+
+    # Valitaan lauseet kyselyn termien osuvuuden mukaan ja palautetaan ne alkuperäisessä järjestyksessä
+    sentences = split_into_sentences(text)
+    ranked = sorted(
+        range(len(sentences)),
+        key=lambda i: len(query_terms.intersection(tokenize(sentences[i]))) / (1 + len(tokenize(sentences[i])) ** 0.5),
+        reverse=True
+    )
+    chosen = []
+    used = 0
+    for i in ranked:
+        tokens = count_tokens(sentences[i])
+        if used + tokens > max_tokens:
+            continue
+        chosen.append(i)
+        used += tokens
+    return " ".join(sentences[i] for i in sorted(chosen))
+
+def pack_context(docs, query_text, budget=CONTEXT_TOKEN_BUDGET, chunk_max_tokens=CONTEXT_CHUNK_MAX_TOKENS):
+    # docs: haun tulokset paremmuusjärjestyksessä. Palauttaa budjettiin mahtuvat (tarvittaessa
+    # lyhennetyt) dokumentit ja tilaston, jossa näkyy kuinka paljon syötetokeneita säästyi.
+    with span("context") as attrs:
+        packed, stats = pack_docs(docs, query_text, budget, chunk_max_tokens)
+        attrs.update(stats)
+    return packed, stats
+
+def pack_docs(docs, query_text, budget, chunk_max_tokens):
+    from keyword_index import tokenize
+
+    query_terms = set(tokenize(query_text or ""))
+    packed = []
+    packed_shingles = []
+    stats = {"candidates": len(docs), "packed": 0, "duplicates": 0, "trimmed": 0, "dropped": 0}
+    candidate_tokens = 0
+    baseline_tokens = 0
+    used = 0
+
+    for index, doc in enumerate(docs):
+        tokens = count_tokens(format_doc(doc))
+        candidate_tokens += tokens
+        if index < CONTEXT_BASELINE_TOP_K:
+            baseline_tokens += tokens
+
+        doc_shingles = shingles(doc["content"])
+        if is_duplicate(doc_shingles, packed_shingles):
+            stats["duplicates"] += 1
+            continue
+
+        remaining = budget - used
+        if tokens > min(chunk_max_tokens, remaining):
+            overhead = count_tokens(format_doc(dict(doc, content="")))
+            limit = min(chunk_max_tokens, remaining) - overhead
+            content = trim_to_budget(doc["content"], query_terms, limit) if limit >= CONTEXT_MIN_TOKENS else ""
+            if not content:
+                stats["dropped"] += 1
+                continue
+            doc = dict(doc, content=content)
+            tokens = count_tokens(format_doc(doc))
+            stats["trimmed"] += 1
+
+        packed.append(doc)
+        packed_shingles.append(doc_shingles)
+        used += tokens
+
+    stats["packed"] = len(packed)
+    stats["candidate_tokens"] = candidate_tokens
+    stats["baseline_tokens"] = baseline_tokens
+    stats["context_tokens"] = used
+    # Voi olla negatiivinen, jos budjettiin mahtuu enemmän kuin kolme kokonaista chunkkia
+    stats["saved_tokens"] = baseline_tokens - used
+    return packed, stats
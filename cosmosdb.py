@@ -1,10 +1,18 @@
 import os
-from openai import AzureOpenAI
+from openai import AzureOpenAI, BadRequestError
 import json
 import sys
-from azure.cosmos import CosmosClient, exceptions
+from azure.cosmos import CosmosClient, PartitionKey, exceptions
 import re
+import hashlib
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from embedding_cache import EMBEDDING_MODEL, get_cache
+from document_store import DOCUMENT_FIELDS, DOCUMENT_TYPE, document_record, item_size, join_document
+from partitioning import COSMOS_PARTITION_KEY, PARTITION_KEY_FIELD, partition_key_for, partition_key_value
+from rate_limit import COSMOS_RU_PER_SEC, backoff, create_embeddings, retry_after_seconds, scheduler
 
 def create_cosmos_client():
 
@@ -52,6 +60,9 @@ def chunk_by_paragraph(doc):
         for i, paragraph in enumerate(paragraphs)
     ]
     
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
 def enrich_chunks(doc, raw_chunks):
     enriched = []
     
@@ -61,40 +72,475 @@ def enrich_chunks(doc, raw_chunks):
                 "id": f"{doc['id']}_chunk_{chunk['chunk_index']}",
                 "parent_doc_id": doc["id"],
                 "chunk_index": chunk["chunk_index"],
-                "title": doc["title"],
                 "content": chunk["content"],
-                "source": f"{doc['id']}: {doc['title']}",
+                "contentHash": content_hash(chunk["content"]),
+                # Suodatuskentät pidetään chunkissa, jotta WHERE-ehto toimii vektorihaun yhteydessä;
+                # muut metatiedot ovat dokumenttitietueessa (document_record)
                 "company": doc["company"],
                 "documentType": doc["documentType"],
                 "version": doc["version"],
                 "status": doc["status"],
                 "effectiveDate": doc["effectiveDate"],
-                "lastUpdated": doc["lastUpdated"],
-                "changeLog": doc["changeLog"],
-                "originalSource": doc["source"],
-                "tags": doc["tags"]
+                PARTITION_KEY_FIELD: partition_key_for(doc)
             }
         )
     return enriched
 
-def chunk_document(doc):
+def chunk_by_sentences(doc, size=5, overlap=1):
+    sentences = split_into_sentences(doc["content"])
+    step = max(1, size - overlap)
+    return [
+        {
+            "chunk_index": i,
+            "content": " ".join(sentences[start:start + size])
+        }
+        for i, start in enumerate(range(0, max(1, len(sentences) - overlap), step))
+    ]
+
+def chunk_auto(doc):
     if len(split_into_sentences(doc["content"])) <= 10:
-        raw = chunk_full_document(doc)
-    elif len(split_into_sentences(doc["content"])) > 10:
-        raw = chunk_by_paragraph(doc)
-    else:
-        raise ValueError("Unknown chunking strategy")
+        return chunk_full_document(doc)
+    return chunk_by_paragraph(doc)
+
+# Chunkausstrategiat; "auto" valitsee koko dokumentin tai kappaleet lauseiden määrän mukaan
+CHUNK_STRATEGIES = {
+    "auto": chunk_auto,
+    "full": chunk_full_document,
+    "paragraph": chunk_by_paragraph,
+    "sentences": chunk_by_sentences
+}
+CHUNK_STRATEGY = os.getenv("CHUNK_STRATEGY", "auto")
+
+def chunk_document(doc, strategy=None):
+    strategy = strategy or CHUNK_STRATEGY
+    if strategy not in CHUNK_STRATEGIES:
+        raise ValueError(f"Unknown chunking strategy: {strategy}")
     
-    return enrich_chunks(doc,raw)
+    return enrich_chunks(doc, CHUNK_STRATEGIES[strategy](doc))
+
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "16"))
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", "32000"))
+
+def estimate_tokens(text):
+    # Karkea arvio: ~4 merkkiä per token riittää batchien pakkaamiseen
+    return len(text) // 4 + 1
+
+def make_batches(chunks, batch_size=EMBED_BATCH_SIZE, max_tokens=EMBED_BATCH_TOKENS):
+    batch = []
+    batch_tokens = 0
+    for chunk in chunks:
+        tokens = estimate_tokens(chunk["content"])
+        if batch and (len(batch) >= batch_size or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(chunk)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+def embed_batch(client, batch, model=EMBEDDING_MODEL):
+    try:
+        # Taustasynkronointi odottaa budjettia eikä luovuta busy-virheellä
+        response = create_embeddings(
+            client,
+            model,
+            [chunk["content"] for chunk in batch],
+            max_wait=None
+        )
+    except BadRequestError as e:
+        if len(batch) == 1:
+            print(f"Failed to embed {batch[0]['id']}: {e}")
+            return {}
+        # Jaetaan batch kahtia ja yritetään uudelleen, jotta liian iso syöte ei kaada muita
+        middle = len(batch) // 2
+        vectors = embed_batch(client, batch[:middle], model)
+        vectors.update(embed_batch(client, batch[middle:], model))
+        return vectors
+
+    return {
+        batch[item.index]["id"]: item.embedding
+        for item in response.data
+    }
+
+def embed_chunks(client, chunks, batch_size=EMBED_BATCH_SIZE, max_tokens=EMBED_BATCH_TOKENS, model=EMBEDDING_MODEL, cache=None):
+    cache = cache or get_cache()
+    cached = cache.get_many(model, [chunk["content"] for chunk in chunks])
+    vectors = {
+        chunk["id"]: vector
+        for chunk, vector in zip(chunks, cached)
+        if vector is not None
+    }
+    missing = [chunk for chunk in chunks if chunk["id"] not in vectors]
+
+    for batch in make_batches(missing, batch_size, max_tokens):
+        batch_vectors = embed_batch(client, batch, model)
+        embedded = [chunk for chunk in batch if chunk["id"] in batch_vectors]
+        cache.put_many(
+            model,
+            [chunk["content"] for chunk in embedded],
+            [batch_vectors[chunk["id"]] for chunk in embedded]
+        )
+        vectors.update(batch_vectors)
+
+    for chunk in chunks:
+        if chunk["id"] in vectors:
+            chunk["embedding"] = vectors[chunk["id"]]
+    return vectors
+
+UPSERT_MAX_WORKERS = int(os.getenv("UPSERT_MAX_WORKERS", "16"))
+UPSERT_MAX_RETRIES = int(os.getenv("UPSERT_MAX_RETRIES", "5"))
+
+class AdaptiveLimiter:
+    # AIMD: rinnakkaisuutta kasvatetaan yhdellä kun RU-kulutus jää budjetin alle
+    # ja puolitetaan kun budjetti ylittyy tai Cosmos palauttaa 429
+    def __init__(self, max_limit, ru_per_sec):
+        self.max_limit = max_limit
+        self.ru_per_sec = ru_per_sec
+        self.limit = max(1, max_limit // 4)
+        self.in_flight = 0
+        self.window_start = time.monotonic()
+        self.window_ru = 0.0
+        self.condition = threading.Condition()
 
-folder = Path("C:/Users/IliaZubov/Documents/Skillio/week 9/AI-Project/docs")
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
 
-doc_files = [
+    def release(self, request_charge=0.0, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+            else:
+                self.window_ru += request_charge
+                elapsed = time.monotonic() - self.window_start
+                if elapsed >= 1.0:
+                    rate = self.window_ru / elapsed
+                    if rate > self.ru_per_sec:
+                        self.limit = max(1, self.limit // 2)
+                    elif rate < self.ru_per_sec * 0.8:
+                        self.limit = min(self.max_limit, self.limit + 1)
+                    self.window_start = time.monotonic()
+                    self.window_ru = 0.0
+            self.condition.notify_all()
+
+def upsert_chunks(container, chunks, max_workers=UPSERT_MAX_WORKERS, ru_per_sec=COSMOS_RU_PER_SEC, max_retries=UPSERT_MAX_RETRIES):
+    limiter = AdaptiveLimiter(max_workers, ru_per_sec)
+    stats = {"written": 0, "failed": 0, "throttled": 0, "request_charge": 0.0}
+    stats_lock = threading.Lock()
+
+    def write(chunk):
+        for attempt in range(max_retries + 1):
+            charge = {}
+
+            def hook(headers, result):
+                charge["value"] = float(headers.get("x-ms-request-charge", 0))
+
+            # Kirjoitukset kuluttavat samaa RU-budjettia kuin haut, jotta synkronointi ei tukehduta chattia
+            time.sleep(scheduler.ru.reserve(0.0))
+            limiter.acquire()
+            try:
+                container.upsert_item(chunk, response_hook=hook)
+            except exceptions.CosmosHttpResponseError as e:
+                if e.status_code == 429 and attempt < max_retries:
+                    limiter.release(throttled=True)
+                    with stats_lock:
+                        stats["throttled"] += 1
+                    delay = backoff(attempt, retry_after_seconds(e))
+                    scheduler.ru.pause(delay)
+                    time.sleep(delay)
+                    continue
+                limiter.release()
+                print(f"Failed to insert {chunk['id']}: {e}")
+                with stats_lock:
+                    stats["failed"] += 1
+                return
+            limiter.release(charge.get("value", 0.0))
+            scheduler.ru.adjust(charge.get("value", 0.0))
+            with stats_lock:
+                stats["written"] += 1
+                stats["request_charge"] += charge.get("value", 0.0)
+            return
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(write, chunks))
+    elapsed = time.monotonic() - start
+
+    stats["seconds"] = elapsed
+    stats["chunks_per_sec"] = stats["written"] / elapsed if elapsed > 0 else 0.0
+    return stats
+
+# Kentät jotka päivitetään uuden version mukana, vaikka chunkin sisältö ei muuttuisi
+VERSION_FIELDS = ["version", "status", "effectiveDate"]
+
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "1536"))
+
+# Suodatuskentät indeksoidaan, jotta WHERE-ehto rajaa vektorihaun ehdokkaat ennen VectorDistancea.
+# Muut polut (ml. changeLog ja sisältö) jätetään indeksoimatta, mikä pienentää kirjoitusten RU-kulua.
+CHUNK_INDEXING_POLICY = {
+    "indexingMode": "consistent",
+    "automatic": True,
+    "includedPaths": [
+        { "path": "/parent_doc_id/?" },
+        { "path": "/type/?" },
+        { "path": "/status/?" },
+        { "path": "/company/?" },
+        { "path": "/documentType/?" },
+        { "path": "/version/?" },
+        { "path": "/effectiveDate/?" }
+    ],
+    "excludedPaths": [
+        { "path": "/*" },
+        { "path": "/embedding/*" }
+    ],
+    "compositeIndexes": [
+        [
+            { "path": "/status", "order": "ascending" },
+            { "path": "/effectiveDate", "order": "ascending" }
+        ]
+    ],
+    "vectorIndexes": [
+        { "path": "/embedding", "type": "quantizedFlat" }
+    ]
+}
+
+CHUNK_VECTOR_EMBEDDING_POLICY = {
+    "vectorEmbeddings": [
+        {
+            "path": "/embedding",
+            "dataType": "float32",
+            "distanceFunction": "cosine",
+            "dimensions": EMBEDDING_DIMENSIONS
+        }
+    ]
+}
+
+def ensure_container(database, container_name, partition_key_path=COSMOS_PARTITION_KEY):
+    return database.create_container_if_not_exists(
+        id=container_name,
+        partition_key=PartitionKey(path=partition_key_path),
+        indexing_policy=CHUNK_INDEXING_POLICY,
+        vector_embedding_policy=CHUNK_VECTOR_EMBEDDING_POLICY
+    )
+
+def apply_indexing_policy(database, container_name):
+    # Olemassa olevan kontin indeksointi päivitetään taustalla; vektoripolitiikkaa ei voi muuttaa jälkikäteen
+    database.replace_container(
+        container_name,
+        partition_key=PartitionKey(path=COSMOS_PARTITION_KEY),
+        indexing_policy=CHUNK_INDEXING_POLICY
+    )
+
+def load_existing_chunks(container, doc_ids):
+    # Palauttaa chunkit ja dokumenttitietueet erikseen. Vanhan mallin chunkeissa on
+    # vielä dokumentin metatiedot (legacy), ja ne kirjoitetaan uudelleen kompaktina.
+    pk_field = COSMOS_PARTITION_KEY.lstrip("/")
+    query = f"""
+        SELECT c.id, c.type, c.parent_doc_id, c.contentHash, c.version, c.status, c.effectiveDate,
+            c.{pk_field}, IS_DEFINED(c.changeLog) AS legacy
+        FROM c
+        WHERE ARRAY_CONTAINS(@ids, c.parent_doc_id)
+        """
+    results = container.query_items(
+        query=query,
+        parameters=[{ "name": "@ids", "value": list(doc_ids) }],
+        enable_cross_partition_query=True
+    )
+    chunks = {}
+    records = {}
+    for item in results:
+        if item.get("type") == DOCUMENT_TYPE:
+            records[item["id"]] = item
+        else:
+            chunks[item["id"]] = item
+
+    # Vanhan mallin chunkeilla ei ole contentHashia; se lasketaan sisällöstä, jotta
+    # muuttumattomien chunkkien upotukset voidaan käyttää uudelleen migraatiossa
+    if any(chunk.get("contentHash") is None for chunk in chunks.values()):
+        legacy = container.query_items(
+            query="""
+                SELECT c.id, c.content
+                FROM c
+                WHERE ARRAY_CONTAINS(@ids, c.parent_doc_id) AND NOT IS_DEFINED(c.contentHash)
+                """,
+            parameters=[{ "name": "@ids", "value": list(doc_ids) }],
+            enable_cross_partition_query=True
+        )
+        for item in legacy:
+            if item["id"] in chunks and "content" in item:
+                chunks[item["id"]]["contentHash"] = content_hash(item["content"])
+    return chunks, records
+
+def size_report(doc, record, chunks):
+    # Vertaa kompaktia mallia vanhaan, jossa dokumentin metatiedot kopioitiin jokaiseen chunkkiin
+    metadata = {field: record[field] for field in DOCUMENT_FIELDS}
+    legacy_bytes = sum(item_size(dict(chunk, **metadata)) for chunk in chunks)
+    compact_bytes = item_size(record) + sum(item_size(chunk) for chunk in chunks)
+    return {
+        "id": doc["id"],
+        "chunks": len(chunks),
+        "legacy_bytes": legacy_bytes,
+        "compact_bytes": compact_bytes,
+        "saved": 1 - compact_bytes / legacy_bytes if legacy_bytes else 0.0
+    }
+
+def plan_sync(documents, existing, existing_records=None):
+    existing_records = existing_records or {}
+    plan = {"write": [], "reuse": [], "refresh": [], "delete": [], "documents": [], "sizes": [], "unchanged": 0}
+    current_ids = set()
+    moved = []
+
+    # Chunkkien id:t ovat järjestysnumeroita, joten lisätty tai poistettu kappale siirtää
+    # myöhempien chunkkien id:t. Sisällöltään ennallaan oleva chunk löydetään tiivisteen avulla
+    # ja sen tallennettu upotus käytetään uudelleen; vain id ja järjestys kirjoitetaan uudelleen.
+    existing_by_hash = {}
+    for item in existing.values():
+        existing_by_hash.setdefault((item.get("parent_doc_id"), item.get("contentHash")), item)
+
+    for doc in documents:
+        record = document_record(doc)
+        record[PARTITION_KEY_FIELD] = partition_key_for(doc)
+        record["contentHash"] = content_hash(json.dumps(record, sort_keys=True, ensure_ascii=False))
+        old_record = existing_records.get(record["id"])
+        if old_record is None or old_record.get("contentHash") != record["contentHash"]:
+            plan["documents"].append(record)
+        if old_record is not None and partition_key_value(old_record) != partition_key_value(record):
+            moved.append(old_record)
+
+        chunks = chunk_document(doc)
+        plan["sizes"].append(size_report(doc, record, chunks))
+        for chunk in chunks:
+            current_ids.add(chunk["id"])
+            old = existing.get(chunk["id"])
+            if old is not None and partition_key_value(old) != partition_key_value(chunk):
+                # Partitioavain ei voi muuttua paikallaan: kirjoitetaan uusi ja poistetaan vanha
+                plan["write"].append(chunk)
+                moved.append(old)
+            elif old is None or old.get("legacy") or old.get("contentHash") != chunk["contentHash"]:
+                # Sama tiiviste samalla id:llä on vanhan mallin chunk: upotus käytetään ja tietue kirjoitetaan kompaktina
+                source = existing_by_hash.get((doc["id"], chunk["contentHash"]))
+                if source is not None:
+                    plan["reuse"].append((chunk, source))
+                else:
+                    plan["write"].append(chunk)
+            elif any(old.get(field) != chunk[field] for field in VERSION_FIELDS):
+                plan["refresh"].append(chunk)
+            else:
+                plan["unchanged"] += 1
+
+    # Vanhan version chunkit joita uusi versio ei enää tuota
+    plan["delete"] = moved + [
+        item for item_id, item in existing.items()
+        if item_id not in current_ids
+    ]
+    return plan
+
+def load_embeddings(container, reuse, batch_size=100):
+    # Siirtyneille chunkeille luetaan vanhan chunkin upotus; puuttuvat upotetaan normaalisti
+    sources = {source["id"]: source for _, source in reuse}
+    embeddings = {}
+    ids = list(sources)
+    for start in range(0, len(ids), batch_size):
+        results = container.query_items(
+            query="SELECT c.id, c.embedding FROM c WHERE ARRAY_CONTAINS(@ids, c.id)",
+            parameters=[{ "name": "@ids", "value": ids[start:start + batch_size] }],
+            enable_cross_partition_query=True
+        )
+        embeddings.update({item["id"]: item["embedding"] for item in results if "embedding" in item})
+    for chunk, source in reuse:
+        if source["id"] in embeddings:
+            chunk["embedding"] = embeddings[source["id"]]
+    return [chunk for chunk, _ in reuse if "embedding" not in chunk]
+
+def refresh_chunk(container, chunk):
+    operations = [
+        { "op": "set", "path": f"/{field}", "value": chunk[field] }
+        for field in VERSION_FIELDS
+    ]
+    container.patch_item(
+        item=chunk["id"],
+        partition_key=partition_key_value(chunk),
+        patch_operations=operations
+    )
+
+def delete_chunk(container, item):
+    try:
+        container.delete_item(item=item["id"], partition_key=partition_key_value(item))
+    except exceptions.CosmosResourceNotFoundError:
+        pass
+
+def update_keyword_index(documents, plan, path=None):
+    # Hybridihaun BM25-indeksi päivitetään samalla suunnitelmalla kuin Cosmos, jotta poistetut
+    # ja muuttuneet chunkit eivät jää avainsanahakuun
+    from keyword_index import KEYWORD_INDEX_PATH, load_index
+    from retrieval import METADATA_FIELDS, RETRIEVAL_HYBRID
+
+    path = path or KEYWORD_INDEX_PATH
+    if not RETRIEVAL_HYBRID and not os.path.exists(path):
+        return None
+    index = load_index(path)
+    records = {doc["id"]: document_record(doc) for doc in documents}
+    # Dokumenttitietueen muutos (esim. otsikko) koskee kaikkia sen chunkkeja
+    changed = {record["id"] for record in plan["documents"]}
+
+    for item in plan["delete"]:
+        index.remove(item["id"])
+    for doc in documents:
+        if doc["id"] in changed:
+            index.sync_document(doc["id"], [join_document(chunk, records[doc["id"]]) for chunk in chunk_document(doc)], METADATA_FIELDS)
+    for chunk in plan["write"] + [chunk for chunk, _ in plan["reuse"]] + plan["refresh"]:
+        if chunk["parent_doc_id"] not in changed:
+            joined = join_document(chunk, records[chunk["parent_doc_id"]])
+            index.add(joined, {field: joined.get(field) for field in METADATA_FIELDS})
+    index.save(path)
+    return index
+
+def sync_documents(client, container, documents, max_workers=UPSERT_MAX_WORKERS, keyword_index_path=None):
+    existing, existing_records = load_existing_chunks(container, [doc["id"] for doc in documents])
+    plan = plan_sync(documents, existing, existing_records)
+
+    print(
+        f"Sync plan: {len(plan['write'])} to embed, {len(plan['reuse'])} with stored embeddings, {len(plan['refresh'])} metadata-only, "
+        f"{plan['unchanged']} unchanged, {len(plan['delete'])} orphaned, "
+        f"{len(plan['documents'])} document records"
+    )
+
+    missing = load_embeddings(container, plan["reuse"]) if plan["reuse"] else []
+    embed_chunks(client, plan["write"] + missing)
+    written = plan["write"] + [chunk for chunk, _ in plan["reuse"]]
+    # Dokumenttitietue kirjoitetaan ensin, jotta haku löytää otsikon uusille chunkeille
+    document_stats = upsert_chunks(container, plan["documents"], max_workers)
+    stats = upsert_chunks(container, [chunk for chunk in written if "embedding" in chunk], max_workers)
+    stats["request_charge"] += document_stats["request_charge"]
+    stats["documents_written"] = document_stats["written"]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda chunk: refresh_chunk(container, chunk), plan["refresh"]))
+        list(executor.map(lambda item: delete_chunk(container, item), plan["delete"]))
+
+    keyword_index = update_keyword_index(documents, plan, keyword_index_path)
+    stats["keyword_index"] = keyword_index.count if keyword_index is not None else None
+    stats["reused"] = len(plan["reuse"])
+    stats["refreshed"] = len(plan["refresh"])
+    stats["deleted"] = len(plan["delete"])
+    stats["unchanged"] = plan["unchanged"]
+    stats["sizes"] = plan["sizes"]
+    stats["embedding_cache"] = get_cache().stats()
+    return stats
+
+def list_doc_files(folder):
+    return [
         str(file.resolve())  # full absolute path
-        for file in folder.iterdir()
+        for file in Path(folder).iterdir()
         if file.is_file() and file.suffix.lower() in (".json")
     ]
 
+folder = Path(os.getenv("DOCS_FOLDER", "C:/Users/IliaZubov/Documents/Skillio/week 9/AI-Project/docs"))
+
 if __name__ in "__main__":
     
     cosmos_client = create_cosmos_client()
@@ -105,7 +551,7 @@ if __name__ in "__main__":
     except exceptions.CosmosHttpResponseError as e:
         print(f"Could not list databases: {e}")
     
-    documents = load_documents(doc_files)
+    documents = load_documents(list_doc_files(folder))
     
     api_key = os.getenv("AZURE_API_KEY")
     api_version = os.getenv("AZURE_API_VERSION")
@@ -121,25 +567,27 @@ if __name__ in "__main__":
     container_name = os.getenv("COSMOS_CONTAINER")
     
     database = cosmos_client.get_database_client(database_name)
-    container = database.get_container_client(container_name)
+    container = ensure_container(database, container_name)
     
-    for doc in documents:
-        
-        chunks = chunk_document(doc)
-        
-        for chunk in chunks:
-            
-            response = client.embeddings.create(
-                model="text-embedding-ada-002",
-                input=chunk["content"]
-            )
-            
-            embedding_vector = response.data[0].embedding
-            
-            chunk["embedding"] = embedding_vector
-            
-            try:
-                container.upsert_item(chunk)
-                print("Document inserted successfully")
-            except exceptions.CosmosHttpResponseError as e:
-                print("Failed to insert document: ", e)
\ No newline at end of file
+    if "--apply-index-policy" in sys.argv:
+        apply_indexing_policy(database, container_name)
+        print("Indexing policy updated")
+    
+    stats = sync_documents(client, container, documents)
+    
+    print(
+        f"Upserted {stats['written']} chunks in {stats['seconds']:.1f}s "
+        f"({stats['chunks_per_sec']:.1f} chunks/sec), "
+        f"{stats['request_charge']:.1f} RU total, "
+        f"{stats['throttled']} throttled, {stats['failed']} failed"
+    )
+    print(
+        f"Refreshed {stats['refreshed']}, deleted {stats['deleted']}, "
+        f"skipped {stats['unchanged']} unchanged chunks"
+    )
+    print("Embedding cache:", stats["embedding_cache"])
+    for size in stats["sizes"]:
+        print(
+            f"  {size['id']}: {size['chunks']} chunks, {size['legacy_bytes']} -> {size['compact_bytes']} bytes "
+            f"({size['saved']:.0%} smaller, embeddings excluded)"
+        )
\ No newline at end of file
@@ -1,36 +1,22 @@
 import os
-from openai import AzureOpenAI
-from cosmosdb import create_cosmos_client
-from functions import pdf_to_json, docx_to_json, txt_to_json
+from clients import get_openai_client, get_retriever
+from context_packing import CONTEXT_CANDIDATES, CONTEXT_TOKEN_BUDGET, format_doc, pack_context, stable_order
+from embedding_cache import embed_text, embed_texts
+from retrieval import DEFAULT_FILTERS, RELEVANCE_THRESHOLD, is_relevant, rank_score
+from prompt_cache import minify_prompt, record_usage
+from tracing import GenerationTimer, span, traced_stream
+from rate_limit import BUDGET_MAX_WAIT, BusyError, admitted_stream, busy_events, create_response, scheduler
+from single_flight import coalesced
+from functions import pdf_to_json, docx_to_json, txt_to_json, load_json
 import json
+import hashlib
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
-cosmos_client = create_cosmos_client()
-
-database_name = os.getenv("COSMOS_DATABASE")
-container_name = os.getenv("COSMOS_CONTAINER")
-
-database = cosmos_client.get_database_client(database_name)
-container = database.get_container_client(container_name)
-
-api_key = os.getenv("AZURE_API_KEY")
-api_version = os.getenv("AZURE_API_VERSION")
-azure_endpoint = os.getenv("AZURE_ENDPOINT")
-
-client = AzureOpenAI(
-    api_key=api_key,
-    api_version=api_version,
-    azure_endpoint=azure_endpoint
-)
-
-PROMPT_TEMPLATE_DOC = """
+# Staattiset ohjeet ensin ja muuttuvat osat lopussa, jotta pyynnöt jakavat välimuistitettavan etuliitteen
+PROMPT_TEMPLATE_DOC = minify_prompt("""
                 You are DocuPRO, an internal document compliance and quality evaluator.
                 
-                User document for evaluation:
-                {input_doc}
-                
-                Relevant documents:
-                {retrieved_docs}
-                
                 Primary role
                 - Evaluate whether a given text complies with the organization’s internal policies and guidelines.
                 - Policies are provided ONLY via embedded documents (retrieved policy context).
@@ -81,143 +67,367 @@ PROMPT_TEMPLATE_DOC = """
                 - The text to be evaluated
                 - Embedded policy documents retrieved via vector search
                 Your goal is to help the author improve the document so it aligns with internal policies while encouraging high-quality, well-structured, and professional documentation.
+""")
+
+PROMPT_INPUT_DOC = """
+
+Relevant documents:
+{retrieved_docs}
+
+User document for evaluation:
+{input_doc}
+"""
+
+PROMPT_TEMPLATE_SECTION = minify_prompt("""
+                You are DocuPRO, an internal document compliance evaluator. You are reviewing ONE section of a longer document.
+                
+                Rules
+                - Base all compliance judgments exclusively on the relevant documents above.
+                - Never invent, infer, or extrapolate policy requirements.
+                - Only report on this section; other sections are evaluated separately.
+                Output (bullet points only, no introduction)
+                - Section status: Compliant / Partially compliant / Non-compliant / Cannot be fully assessed
+                - For each issue: exact text excerpt, policy reference (document identifier and section), issue, correction suggestion
+                - If no issues are found, state that no policy deviations were detected in this section
+""")
+
+PROMPT_INPUT_SECTION = """
+
+Relevant documents:
+{retrieved_docs}
+
+Document section {section_number}/{section_count}:
+{input_doc}
 """
 
+PROMPT_TEMPLATE_REDUCE = minify_prompt("""
+                You are DocuPRO, an internal document compliance and quality evaluator.
+                
+                A long document was evaluated section by section against internal policies. The per-section findings and the relevant documents follow the instructions.
+                
+                Task
+                - Merge the per-section findings into a single report for the whole document.
+                - Remove duplicate findings and keep the exact excerpts and policy references from the findings.
+                - Base all compliance judgments exclusively on the findings and the relevant documents; never invent policy requirements.
+                Required output structure (always follow this order)
+                Section 1: Overall assessment
+                - Compliance status: Compliant / Partially compliant / Non-compliant / Cannot be fully assessed
+                - Short rationale (2–3 sentences maximum)
+                Section 2: Policy-based findings
+                For each issue:
+                - Text excerpt: Quote the exact relevant part of the evaluated text
+                - Policy reference: Cite the embedded document identifier and section
+                - Issue: Explain precisely why this part is non-compliant, unclear, or incomplete
+                - Correction suggestion: Provide a specific, actionable rewrite or addition
+                If no issues are found:
+                - Explicitly state that no policy deviations were detected based on the available documents
+                Section 3: General improvement suggestions (non-policy)
+                - Provide 3–4 concise, constructive suggestions
+                - Clearly distinguish these from policy requirements
+                Tone and style
+                - Professional, neutral, and constructive
+                - Avoid legal conclusions; this is a policy evaluation, not legal advice
+""")
+
+PROMPT_INPUT_REDUCE = """
+
+Relevant documents:
+{retrieved_docs}
+
+Per-section findings:
+{section_findings}
+"""
+
+MODEL_NAME = "gpt-4.1"
+# Ylimitoitettu ehdokasjoukko; pack_context rajaa kontekstin tokenibudjettiin
+TOP_K = CONTEXT_CANDIDATES
+
+# Tätä pidemmät dokumentit arvioidaan osioittain (map-reduce)
+MAP_REDUCE_MIN_CHARS = int(os.getenv("MAP_REDUCE_MIN_CHARS", "8000"))
+SECTION_MAX_CHARS = int(os.getenv("SECTION_MAX_CHARS", "6000"))
+SECTION_WORKERS = int(os.getenv("SECTION_WORKERS", "4"))
+
+def join_docs(docs):
+    return "\n\n".join(format_doc(doc) for doc in stable_order(docs))
+
 def build_doc_prompt(input_doc, docs):
-    joined_docs = "\n\n".join(
-    [
-        f"Title: {doc['title']}\n"
-        f"Content: {doc['content']}"
-        for doc in docs
-    ]
-    )
-    return PROMPT_TEMPLATE_DOC.format(
+    joined_docs = join_docs(docs)
+    return PROMPT_TEMPLATE_DOC + PROMPT_INPUT_DOC.format(
         retrieved_docs=joined_docs,
         input_doc=input_doc
     )
     
-def doc_function(filename):
+CONVERTERS = {
+    "pdf": pdf_to_json,
+    "docx": docx_to_json,
+    "txt": txt_to_json,
+    "json": load_json
+}
 
+def load_document_text(source, filename=None, save_to=None):
+    # source voi olla polku, tavut tai tiedostomainen olio; filename kertoo tyypin kun source ei ole polku
+    filename = filename or str(getattr(source, "name", source))
     file_type = filename.split('.')[-1].lower()
     print(f"File type: {file_type}")
 
-    if file_type == "pdf":
-        json_data = pdf_to_json(filename)
-        print(f"✅ Converted {filename} (PDF)")
-    elif file_type == "docx":
-        json_data = docx_to_json(filename)
-        print(f"✅ Converted {filename} (DOCX)")
-    elif file_type == "txt":
-        json_data = txt_to_json(filename)
-        print(f"✅ Converted {filename} (TXT)")
-    elif file_type == "json":
-        with open(filename, 'r', encoding='utf-8') as f:
-            json_data = json.load(f)
-        print(f"✅ Loaded {filename} (JSON)")
-    else:
+    if file_type not in CONVERTERS:
         print(f"\n❌ Couldn't determine file type!")
         print(f"Supported formats: PDF, DOCX, TXT, JSON")
         print(f"Your file: {filename}\n")
-        #continue
-
-    # Seivataan input_doc.jsoniksi
-    with open("input_doc.json", "w", encoding="utf-8") as f:
-        json.dump(json_data, f, ensure_ascii=False, indent=2)
-    print(f"✅ Saved to input_doc.json")
-
-    input_doc = "input_doc.json"
-
-    try:
-        with open(input_doc, "r", encoding="utf-8") as f:
-            doc = json.load(f)
-            
-            # Extract content based on structure
-            if 'content' in doc:
-                text_to_embed = doc['content']
-            elif 'paragraphs' in doc:
-                text_to_embed = "\n".join([p['text'] for p in doc['paragraphs']])
-            elif 'pages' in doc:
-                text_to_embed = "\n".join([p['text'] for p in doc['pages']])
-            else:
-                text_to_embed = str(doc)
-            
-            response = client.embeddings.create(
-            model="text-embedding-ada-002",
-            input=text_to_embed[:8000]  # Limit to avoid token limits
-            )
-            
-            embedding_vector = response.data[0].embedding
-                
-    except Exception as e:
-                print("Request failed with error:", e)
-                return {"response": f"Error: {str(e)}", "sources": []}
-                
-    MODEL_NAME = "gpt-4.1"
-    TOP_K = 3                   
-    RELEVANCE_THRESHOLD = 0.75
-                
-    query = f"""
-            SELECT TOP {TOP_K}
-                c.id,
-                c.title,
-                c.content,
-                c.source,
-                c.originalSource,
-                VectorDistance(c.embedding, @q) AS score
-            FROM c
-            ORDER BY VectorDistance(c.embedding, @q)
-            """
-
-    parameters = [
-        { "name": "@q", "value": embedding_vector }
-    ]
-
-    results = list(container.query_items(
-        query=query,
-        parameters=parameters,
-        enable_cross_partition_query=True
-    ))
+        raise ValueError(f"Unsupported file type: {file_type}")
 
+    with span("convert", file_type=file_type):
+        doc = CONVERTERS[file_type](source, name=filename, save_to=save_to)
+    print(f"✅ Converted {filename} ({file_type.upper()})")
+        
+    # Extract content based on structure
+    if 'content' in doc:
+        return doc['content']
+    elif 'paragraphs' in doc:
+        return "\n".join([p['text'] for p in doc['paragraphs']])
+    elif 'pages' in doc:
+        return "\n".join([p['text'] for p in doc['pages']])
+    else:
+        return str(doc)
 
-    filtered_results = [
-        r for r in results
-        if r["score"] >= RELEVANCE_THRESHOLD
-    ]
+def split_sections(text, max_chars=SECTION_MAX_CHARS):
+    paragraphs = [p.strip() for p in text.split("\n\n") if p.strip()]
+    if len(paragraphs) <= 1:
+        paragraphs = [p.strip() for p in text.split("\n") if p.strip()]
 
-    if not filtered_results:
-        print("\nAssistant: I don't know.")
-        print("\nSources: none")
-        print("\n---\n")
-        #continue
+    sections = []
+    current = ""
+    for paragraph in paragraphs:
+        # Ylipitkä kappale pilkotaan kovasti, jotta yksikään osio ei ylitä rajaa
+        while len(paragraph) > max_chars:
+            if current:
+                sections.append(current)
+                current = ""
+            sections.append(paragraph[:max_chars])
+            paragraph = paragraph[max_chars:]
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            sections.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        sections.append(current)
+    return sections
 
-    retrieved_docs = [
+def to_retrieved_docs(results):
+    return [
         {
             "title": r["title"],
             "content": r["content"],
             "source": r["source"],
             "originalSource": r["originalSource"]
         }
-        for r in filtered_results
+        for r in results
     ]
 
-    sources = list(dict.fromkeys(doc["source"] for doc in retrieved_docs))
+def merge_context_stats(stats_list):
+    merged = {}
+    for stats in stats_list:
+        for key, value in stats.items():
+            merged[key] = merged.get(key, 0) + value
+    return merged
+
+def stream_response(prompt, sources, context=None, prompt_name="doc", max_wait=BUDGET_MAX_WAIT):
+    assistant_response = ""
+    usage = None
+    busy = False
                 
     try:
-        response = client.responses.create(
+        timer = GenerationTimer(prompt_name)
+        response = create_response(
+                get_openai_client(),
+                max_wait=max_wait,
                 model=MODEL_NAME,
-                input=build_doc_prompt(text_to_embed, retrieved_docs),
+                input=prompt,
                 temperature=0.1,
                 max_output_tokens=1000,
-                stream=False
+                prompt_cache_key=prompt_name,
+                stream=True
             )
             
-        assistant_response = response.output_text
+        for event in response:
+            
+            if event.type == "response.output_text.delta":
+                timer.delta()
+                assistant_response += event.delta
+                yield {"type": "delta", "text": event.delta}
+                
+            if event.type == "response.completed":
+                usage = record_usage(prompt_name, event.response.usage)
+        timer.done(usage)
+            
+    except BusyError as e:
+        busy = True
+        assistant_response = str(e)
+        yield {"type": "delta", "text": assistant_response}
             
     except Exception as e:
         print("Request failed with error:", e)
         assistant_response = f"Error: {str(e)}"
+        yield {"type": "delta", "text": assistant_response}
     
-    return {
+    yield {
+        "type": "done",
         "response": assistant_response,
-        "sources": sources
-    }
\ No newline at end of file
+        "sources": sources,
+        "usage": usage,
+        "context": context,
+        "busy": busy
+    }
+
+def evaluate_section(section_number, section_count, section, docs):
+    timer = GenerationTimer("doc_section")
+    response = create_response(
+        get_openai_client(),
+        max_wait=None,
+        model=MODEL_NAME,
+        input=PROMPT_TEMPLATE_SECTION + PROMPT_INPUT_SECTION.format(
+            section_number=section_number,
+            section_count=section_count,
+            input_doc=section,
+            retrieved_docs=join_docs(docs)
+        ),
+        temperature=0.1,
+        max_output_tokens=1000,
+        prompt_cache_key="doc_section",
+        stream=False
+    )
+    usage = record_usage("doc_section", response.usage)
+    timer.done(usage)
+    return response.output_text, usage
+
+def stream_doc_sections(text, filters=None):
+    # Map: jokainen osio haetaan ja arvioidaan erikseen, Reduce: löydökset yhdistetään yhdeksi raportiksi
+    # Budjetti tarkistetaan kerran koko työlle; osiot ja reduce odottavat vuoroaan TPM-budjetissa
+    scheduler.check_openai_budget(MODEL_NAME)
+    sections = split_sections(text)
+    section_embeddings = embed_texts(get_openai_client(), sections)
+    section_results = get_retriever().search_batch(section_embeddings, TOP_K, query_texts=sections, filters=filters)
+
+    unique_results = {}
+    section_docs = []
+    context_stats = []
+    for section, results in zip(sections, section_results):
+        filtered_results = [r for r in results if is_relevant(r, RELEVANCE_THRESHOLD)]
+        for r in filtered_results:
+            if r["id"] not in unique_results or rank_score(r) > rank_score(unique_results[r["id"]]):
+                unique_results[r["id"]] = r
+        # Osioille riittää pienempi budjetti, koska jokainen kutsu arvioi vain yhden osion
+        packed, stats = pack_context(filtered_results, section, CONTEXT_TOKEN_BUDGET // 2)
+        section_docs.append(to_retrieved_docs(packed))
+        context_stats.append(stats)
+
+    ranked = sorted(unique_results.values(), key=rank_score, reverse=True)
+    packed, stats = pack_context(ranked, text[:8000])
+    context_stats.append(stats)
+    retrieved_docs = to_retrieved_docs(packed)
+    sources = list(dict.fromkeys(doc["source"] for doc in retrieved_docs))
+
+    with ThreadPoolExecutor(max_workers=SECTION_WORKERS) as executor:
+        futures = [
+            # Kontekstin kopio säilyttää trace_id:n säikeissä
+            executor.submit(contextvars.copy_context().run, evaluate_section, i + 1, len(sections), section, docs)
+            for i, (section, docs) in enumerate(zip(sections, section_docs))
+        ]
+        findings = [future.result() for future in futures]
+
+    section_findings = "\n\n".join(
+        f"Section {i + 1}:\n{output_text}"
+        for i, (output_text, _) in enumerate(findings)
+    )
+    prompt = PROMPT_TEMPLATE_REDUCE + PROMPT_INPUT_REDUCE.format(
+        section_findings=section_findings,
+        retrieved_docs=join_docs(retrieved_docs)
+    )
+    for event in stream_response(prompt, sources, merge_context_stats(context_stats), "doc_reduce", max_wait=None):
+        if event["type"] == "done" and event["usage"] is not None:
+            for key in ("input_tokens", "output_tokens", "cached_tokens"):
+                event["usage"][key] += sum(usage[key] for _, usage in findings)
+        yield event
+
+def source_bytes(source):
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    if hasattr(source, "getvalue"):
+        return source.getvalue()
+    if isinstance(source, (str, os.PathLike)) and os.path.isfile(source):
+        with open(source, "rb") as f:
+            return f.read()
+    # Muut tiedostomaiset oliot voi lukea vain kerran, joten niitä ei yhdistetä
+    return None
+
+def doc_flight_key(source, filename=None, map_reduce=None, filters=None):
+    content = source_bytes(source)
+    if content is None:
+        return None
+    filename = filename or str(getattr(source, "name", source))
+    filters = {**DEFAULT_FILTERS, **(filters or {})}
+    return (
+        "doc",
+        hashlib.sha256(content).hexdigest(),
+        filename.split('.')[-1].lower(),
+        map_reduce,
+        json.dumps(filters, sort_keys=True)
+    )
+
+@coalesced(doc_flight_key)
+@traced_stream("doc")
+@admitted_stream
+def stream_doc(source, filename=None, map_reduce=None, filters=None):
+
+    filters = {**DEFAULT_FILTERS, **(filters or {})}
+
+    try:
+        text_to_embed = load_document_text(source, filename)
+        
+        if map_reduce is None:
+            map_reduce = len(text_to_embed) > MAP_REDUCE_MIN_CHARS
+        
+        if map_reduce:
+            yield from stream_doc_sections(text_to_embed, filters)
+            return
+        
+        embedding_vector = embed_text(get_openai_client(), text_to_embed[:8000])  # Limit to avoid token limits
+        results = get_retriever().search(embedding_vector, TOP_K, query_text=text_to_embed[:8000], filters=filters)
+
+        filtered_results, context = pack_context(
+            [r for r in results if is_relevant(r, RELEVANCE_THRESHOLD)],
+            text_to_embed[:8000]
+        )
+                
+    except BusyError as e:
+        yield from busy_events(e)
+        return
+                
+    except Exception as e:
+        print("Request failed with error:", e)
+        yield {"type": "delta", "text": f"Error: {str(e)}"}
+        yield {"type": "done", "response": f"Error: {str(e)}", "sources": [], "usage": None}
+        return
+
+    if not filtered_results:
+        print("\nAssistant: I don't know.")
+        print("\nSources: none")
+        print("\n---\n")
+        #continue
+
+    retrieved_docs = to_retrieved_docs(filtered_results)
+
+    sources = list(dict.fromkeys(doc["source"] for doc in retrieved_docs))
+                
+    yield from stream_response(build_doc_prompt(text_to_embed, retrieved_docs), sources, context)
+
+def doc_function(source, filename=None, map_reduce=None, filters=None):
+    
+    for event in stream_doc(source, filename, map_reduce, filters):
+        if event["type"] == "done":
+            return {
+                "response": event["response"],
+                "sources": event["sources"],
+                "usage": event["usage"],
+                "busy": event.get("busy", False)
+            }
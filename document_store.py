@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import threading
+from rate_limit import query_items
+
+# Dokumentin metatiedot tallennetaan kerran omaan tietueeseensa (type = "document")
+# samaan konttiin chunkkien kanssa. Chunkeissa on vain teksti, upotus ja avain- ja
+# suodatuskentät; haku liittää otsikon ja lähteen tuloksiin prosessin välimuistista.
+DOCUMENT_TYPE = "document"
+# Kentät jotka ovat vain dokumenttitietueessa
+DOCUMENT_FIELDS = ["title", "source", "originalSource", "lastUpdated", "changeLog", "tags"]
+# Kentät jotka liitetään hakutuloksiin
+JOINED_FIELDS = ["title", "source", "originalSource"]
+
+DOCUMENT_CACHE_TTL = float(os.getenv("DOCUMENT_CACHE_TTL", "600"))
+DOCUMENT_CACHE_MAX_ENTRIES = int(os.getenv("DOCUMENT_CACHE_MAX_ENTRIES", "10000"))
+
+def document_record(doc):
+    return {
+        "id": doc["id"],
+        "type": DOCUMENT_TYPE,
+        "parent_doc_id": doc["id"],
+        "title": doc["title"],
+        "source": f"{doc['id']}: {doc['title']}",
+        "company": doc["company"],
+        "documentType": doc["documentType"],
+        "version": doc["version"],
+        "status": doc["status"],
+        "effectiveDate": doc["effectiveDate"],
+        "lastUpdated": doc["lastUpdated"],
+        "changeLog": doc["changeLog"],
+        "originalSource": doc["source"],
+        "tags": doc["tags"]
+    }
+
+def join_document(chunk, record):
+    if record is None:
+        # Ennen uudelleensynkronointia kirjoitetuissa chunkeissa otsikko ja lähde ovat vielä chunkissa;
+        # jos niitäkään ei ole, tuloksessa näytetään dokumentin tunniste
+        parent_doc_id = chunk.get("parent_doc_id")
+        fallback = {"title": parent_doc_id, "source": parent_doc_id, "originalSource": None}
+        return dict(chunk, **{field: chunk.get(field) or fallback[field] for field in JOINED_FIELDS})
+    return dict(chunk, **{field: record.get(field) for field in JOINED_FIELDS})
+
+def item_size(item):
+    # Tietueen koko JSON-muodossa; upotus jätetään pois, koska se on sama kummassakin mallissa
+    return len(json.dumps({key: value for key, value in item.items() if key != "embedding"}, ensure_ascii=False).encode("utf-8"))
+
+def document_query(parent_doc_ids):
+    return (
+        f"""
+        SELECT c.id, c.version, {", ".join(f"c.{field}" for field in JOINED_FIELDS)}
+        FROM c
+        WHERE c.type = @type AND ARRAY_CONTAINS(@ids, c.id)
+        """,
+        [
+            { "name": "@type", "value": DOCUMENT_TYPE },
+            { "name": "@ids", "value": list(parent_doc_ids) }
+        ]
+    )
+
+class DocumentCache:
+    # Dokumenttitietueet parent_doc_id:n mukaan. Tietue haetaan uudelleen, jos se on
+    # vanhentunut tai chunkin versio ei vastaa välimuistissa olevaa.
+    def __init__(self, ttl=DOCUMENT_CACHE_TTL, max_entries=DOCUMENT_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.records = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def missing(self, results):
+        now = time.time()
+        wanted = set()
+        with self.lock:
+            for r in results:
+                entry = self.records.get(r["parent_doc_id"])
+                if entry is None or now - entry["fetched"] > self.ttl or entry["record"].get("version") != r.get("version"):
+                    wanted.add(r["parent_doc_id"])
+        return sorted(wanted)
+
+    def update(self, records):
+        now = time.time()
+        with self.lock:
+            for record in records:
+                self.records[record["id"]] = {"record": record, "fetched": now}
+            while len(self.records) > self.max_entries:
+                del self.records[next(iter(self.records))]
+
+    def attach(self, results):
+        with self.lock:
+            return [
+                join_document(r, self.records[r["parent_doc_id"]]["record"] if r["parent_doc_id"] in self.records else None)
+                for r in results
+            ]
+
+    def count(self, results, fetched):
+        with self.lock:
+            self.misses += len(fetched)
+            self.hits += len({r["parent_doc_id"] for r in results}) - len(fetched)
+
+    def join(self, container, results, charges=None):
+        parent_doc_ids = self.missing(results)
+        self.count(results, parent_doc_ids)
+        if parent_doc_ids:
+            query, parameters = document_query(parent_doc_ids)
+            self.update(query_items(container, charges, query=query, parameters=parameters, enable_cross_partition_query=True))
+        return self.attach(results)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.records), "hits": self.hits, "misses": self.misses}
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_document_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = DocumentCache()
+        return _cache
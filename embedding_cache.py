@@ -0,0 +1,145 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from tracing import span
+from rate_limit import create_embeddings
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "100000"))
+EMBED_REQUEST_SIZE = 16
+
+def cache_key(model, text):
+    return f"{model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+class EmbeddingCache:
+    # Levylle tallennettu LRU-välimuisti: avain on mallin nimi + tekstin hash,
+    # vektorit tallennetaan float32-muodossa
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings(last_used)")
+        self.connection.commit()
+
+    def get_many(self, model, texts):
+        keys = [cache_key(model, text) for text in texts]
+        found = {}
+        with self.lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})",
+                    batch
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self.connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+                self.connection.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+
+        vectors = []
+        for key in keys:
+            if key in found:
+                vector = array("f")
+                vector.frombytes(found[key])
+                vectors.append(vector.tolist())
+            else:
+                vectors.append(None)
+        return vectors
+
+    def put_many(self, model, texts, vectors):
+        now = time.time()
+        rows = [
+            (cache_key(model, text), array("f", vector).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                rows
+            )
+            self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        count = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        # Poistetaan kerralla vähän ylimääräistä, ettei jokainen lisäys joudu karsimaan
+        excess = count - self.max_entries + self.max_entries // 10
+        self.connection.execute(
+            """
+            DELETE FROM embeddings WHERE key IN (
+                SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?
+            )
+            """,
+            (excess,)
+        )
+
+    def stats(self):
+        with self.lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+        return _cache
+
+def embed_texts(client, texts, model=EMBEDDING_MODEL, cache=None):
+    cache = cache or get_cache()
+    with span("embed", texts=len(texts)) as attrs:
+        vectors = cache.get_many(model, texts)
+
+        # Sama teksti voi esiintyä useaan kertaan, upotetaan se vain kerran
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        attrs["cache_misses"] = len(missing)
+        embedded = {}
+        for start in range(0, len(missing), EMBED_REQUEST_SIZE):
+            batch = missing[start:start + EMBED_REQUEST_SIZE]
+            response = create_embeddings(client, model, batch)
+            batch_vectors = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            cache.put_many(model, batch, batch_vectors)
+            embedded.update(zip(batch, batch_vectors))
+
+    return [
+        vector if vector is not None else embedded[text]
+        for text, vector in zip(texts, vectors)
+    ]
+
+def embed_text(client, text, model=EMBEDDING_MODEL, cache=None):
+    return embed_texts(client, [text], model, cache)[0]
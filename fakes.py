@@ -0,0 +1,305 @@
+import os
+import re
+import time
+import zlib
+import hashlib
+import threading
+from types import SimpleNamespace
+import numpy as np
+from azure.cosmos import exceptions
+
+# Paikalliset korvikkeet Azure OpenAI:lle ja Cosmos DB:n kontille benchmarkeja ja
+# offline-ajoja varten. Ne toteuttavat vain ne osat rajapinnoista, joita tämä repo käyttää,
+# ja simuloivat viiveen, striimauksen, RU-kulut, 429-vastaukset ja prompt-välimuistin.
+
+FAKE_EMBEDDING_DIM = int(os.getenv("FAKE_EMBEDDING_DIM", "1536"))
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def fake_embedding(text, dim=FAKE_EMBEDDING_DIM):
+    # Hajautettu sanapussi + yhteinen komponentti: samoja sanoja sisältävät tekstit ovat
+    # lähellä toisiaan, ja kosinisamankaltaisuudet osuvat samalle alueelle kuin ada-002:lla
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in TOKEN_PATTERN.findall(text.lower()):
+        index = zlib.crc32(word.encode("utf-8")) % (dim - 1) + 1
+        vector[index] += 1.0
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector *= np.sqrt(0.3) / norm
+    vector[0] = np.sqrt(0.7)
+    return vector.tolist()
+
+def sleep_ms(ms):
+    if ms > 0:
+        time.sleep(ms / 1000)
+
+class FakeEmbeddings:
+    def __init__(self, latency_ms=20.0, per_input_ms=0.5):
+        self.latency_ms = latency_ms
+        self.per_input_ms = per_input_ms
+        self.calls = 0
+        self.inputs = 0
+        self.lock = threading.Lock()
+
+    def create(self, model, input, **kwargs):
+        texts = [input] if isinstance(input, str) else list(input)
+        with self.lock:
+            self.calls += 1
+            self.inputs += len(texts)
+        sleep_ms(self.latency_ms + self.per_input_ms * len(texts))
+        return SimpleNamespace(
+            data=[SimpleNamespace(index=i, embedding=fake_embedding(text)) for i, text in enumerate(texts)],
+            usage=SimpleNamespace(prompt_tokens=sum(len(text) // 4 + 1 for text in texts))
+        )
+
+class FakeResponses:
+    # Striimaava responses-rajapinta. Välimuistitetut syötetokenit lasketaan kuten palvelussa:
+    # yhteinen etuliite aiempien pyyntöjen kanssa 128 tokenin paloina, kun etuliite on vähintään 1024 tokenia.
+    CHARS_PER_TOKEN = 4
+    CACHE_BLOCK_TOKENS = 128
+    CACHE_MIN_TOKENS = 1024
+
+    def __init__(self, ttft_ms=150.0, token_ms=2.0, output_tokens=150, tokens_per_delta=4):
+        self.ttft_ms = ttft_ms
+        self.token_ms = token_ms
+        self.output_tokens = output_tokens
+        self.tokens_per_delta = tokens_per_delta
+        self.prefixes = set()
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def cached_tokens(self, prompt):
+        block = self.CACHE_BLOCK_TOKENS * self.CHARS_PER_TOKEN
+        boundaries = range(block, len(prompt) + 1, block)
+        digests = [hashlib.sha1(prompt[:end].encode("utf-8")).digest() for end in boundaries]
+        with self.lock:
+            self.calls += 1
+            cached_blocks = 0
+            for digest in digests:
+                if digest not in self.prefixes:
+                    break
+                cached_blocks += 1
+            self.prefixes.update(digests)
+        cached = cached_blocks * self.CACHE_BLOCK_TOKENS
+        return cached if cached >= self.CACHE_MIN_TOKENS else 0
+
+    def usage(self, prompt):
+        return SimpleNamespace(
+            input_tokens=len(prompt) // self.CHARS_PER_TOKEN + 1,
+            output_tokens=self.output_tokens,
+            input_tokens_details=SimpleNamespace(cached_tokens=self.cached_tokens(prompt))
+        )
+
+    def words(self):
+        return [f"word{i % 50} " for i in range(self.output_tokens)]
+
+    def create(self, model, input, stream=False, **kwargs):
+        usage = self.usage(input)
+        if not stream:
+            sleep_ms(self.ttft_ms + self.token_ms * self.output_tokens)
+            return SimpleNamespace(output_text="".join(self.words()), usage=usage)
+        return self.stream(usage)
+
+    def stream(self, usage):
+        sleep_ms(self.ttft_ms)
+        words = self.words()
+        for start in range(0, len(words), self.tokens_per_delta):
+            delta = "".join(words[start:start + self.tokens_per_delta])
+            yield SimpleNamespace(type="response.output_text.delta", delta=delta)
+            sleep_ms(self.token_ms * self.tokens_per_delta)
+        yield SimpleNamespace(type="response.completed", response=SimpleNamespace(usage=usage))
+
+class FakeOpenAI:
+    def __init__(self, embeddings=None, responses=None):
+        self.embeddings = embeddings or FakeEmbeddings()
+        self.responses = responses or FakeResponses()
+
+# --- Cosmos ---
+
+QUERY_PATTERN = re.compile(
+    r"^SELECT (?P<distinct>DISTINCT )?(?:TOP (?P<top>\d+) )?(?P<fields>.+?) FROM c"
+    r"(?: WHERE (?P<where>.+?))?(?: ORDER BY (?P<order>.+))?$"
+)
+CONDITION_PATTERN = re.compile(r"^c\.(\w+) (=|!=|<=|>=|<|>) (@\w+)$")
+OPERATORS = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "<": lambda a, b: a is not None and a < b,
+    ">": lambda a, b: a is not None and a > b
+}
+
+def split_top_level(text, separator=","):
+    parts = []
+    depth = 0
+    current = ""
+    for char in text:
+        depth += char == "("
+        depth -= char == ")"
+        if char == separator and depth == 0:
+            parts.append(current.strip())
+            current = ""
+        else:
+            current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+class FakeContainer:
+    # Muistissa toimiva kontti, joka ymmärtää tämän repon kyselymuodot: SELECT [DISTINCT] [TOP n]
+    # kentät / VectorDistance / IS_DEFINED, WHERE-ehdot AND-ketjuna ja ORDER BY VectorDistance.
+    # RU-malli on karkea: kiinteä kulu per kysely ja partitio + skannattujen rivien mukaan kasvava osa.
+    def __init__(self, partition_key="/id", physical_partitions=4, latency_ms=5.0, ru_per_sec=None):
+        self.partition_key = partition_key.lstrip("/")
+        self.physical_partitions = physical_partitions
+        self.latency_ms = latency_ms
+        self.ru_per_sec = ru_per_sec
+        self.items = {}
+        self.vectors = {}
+        self.window_start = time.monotonic()
+        self.window_ru = 0.0
+        self.request_charge = 0.0
+        self.lock = threading.Lock()
+
+    def key(self, item):
+        return (str(item[self.partition_key]), item["id"])
+
+    def range_of(self, partition_value):
+        return zlib.crc32(str(partition_value).encode("utf-8")) % self.physical_partitions
+
+    def charge(self, request_units, response_hook=None, result=None):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 1.0:
+                self.window_start = now
+                self.window_ru = 0.0
+            if self.ru_per_sec is not None and self.window_ru + request_units > self.ru_per_sec:
+                retry_after_ms = (1.0 - (now - self.window_start)) * 1000
+                error = exceptions.CosmosHttpResponseError(status_code=429, message="Request rate is large")
+                error.headers = {"x-ms-retry-after-ms": f"{retry_after_ms:.0f}"}
+                raise error
+            self.window_ru += request_units
+            self.request_charge += request_units
+        if response_hook is not None:
+            response_hook({"x-ms-request-charge": f"{request_units:.2f}"}, result)
+
+    # Kirjoitukset
+
+    def upsert_item(self, body, response_hook=None, **kwargs):
+        sleep_ms(self.latency_ms)
+        item = dict(body)
+        size_kb = len(str(item)) / 1024
+        self.charge(5.0 + 1.5 * size_kb, response_hook, item)
+        with self.lock:
+            self.items[self.key(item)] = item
+            if "embedding" in item:
+                vector = np.asarray(item["embedding"], dtype=np.float32)
+                self.vectors[self.key(item)] = vector / np.linalg.norm(vector)
+            else:
+                self.vectors.pop(self.key(item), None)
+        return item
+
+    def patch_item(self, item, partition_key, patch_operations, **kwargs):
+        sleep_ms(self.latency_ms)
+        key = (str(partition_key), item)
+        with self.lock:
+            if key not in self.items:
+                raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Not found")
+            for operation in patch_operations:
+                self.items[key][operation["path"].lstrip("/")] = operation["value"]
+        self.charge(10.0, kwargs.get("response_hook"))
+        return self.items[key]
+
+    def delete_item(self, item, partition_key, **kwargs):
+        sleep_ms(self.latency_ms)
+        key = (str(partition_key), item)
+        with self.lock:
+            if key not in self.items:
+                raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Not found")
+            del self.items[key]
+            self.vectors.pop(key, None)
+        self.charge(5.0, kwargs.get("response_hook"))
+
+    # Luvut
+
+    def read_feed_ranges(self, **kwargs):
+        return [{"fakeRange": index} for index in range(self.physical_partitions)]
+
+    def read_all_items(self, **kwargs):
+        with self.lock:
+            return [dict(item) for item in self.items.values()]
+
+    def query_items(self, query, parameters=None, partition_key=None, feed_range=None,
+                    enable_cross_partition_query=None, response_hook=None, **kwargs):
+        params = {p["name"]: p["value"] for p in parameters or []}
+        match = QUERY_PATTERN.match(" ".join(query.split()))
+        if match is None:
+            raise ValueError(f"Unsupported query: {query}")
+
+        with self.lock:
+            keys = [
+                key for key in self.items
+                if (partition_key is None or key[0] == str(partition_key))
+                and (feed_range is None or self.range_of(key[0]) == feed_range["fakeRange"])
+            ]
+            items = [(key, self.items[key]) for key in keys]
+            vectors = self.vectors
+
+        conditions = [condition for condition in (match["where"] or "").split(" AND ") if condition]
+        candidates = [(key, item) for key, item in items if all(self.evaluate(c, item, params) for c in conditions)]
+
+        query_vector = None
+        if "VectorDistance" in query:
+            query_vector = np.asarray(params["@q"], dtype=np.float32)
+            query_vector /= np.linalg.norm(query_vector)
+            candidates = [(key, item) for key, item in candidates if key in vectors]
+            scores = {key: float(vectors[key] @ query_vector) for key, _ in candidates}
+            if match["order"]:
+                candidates.sort(key=lambda entry: scores[entry[0]], reverse=True)
+        else:
+            scores = {}
+
+        if match["top"]:
+            candidates = candidates[:int(match["top"])]
+
+        fields = split_top_level(match["fields"])
+        results = [self.project(fields, item, scores.get(key)) for key, item in candidates]
+        if match["distinct"]:
+            results = list({tuple(sorted(r.items())): r for r in results}.values())
+
+        # Rajaamaton kysely käy läpi kaikki fyysiset partitiot
+        fan_out = 1 if partition_key is not None or feed_range is not None else self.physical_partitions
+        sleep_ms(self.latency_ms * (1 if fan_out == 1 else 1 + 0.25 * fan_out))
+        self.charge(2.5 * fan_out + 0.02 * len(items) + 0.1 * len(results), response_hook, results)
+        return iter(results)
+
+    def evaluate(self, condition, item, params):
+        condition = condition.strip()
+        if condition.startswith("NOT "):
+            return not self.evaluate(condition[4:], item, params)
+        if condition.startswith("IS_DEFINED(c."):
+            return condition[len("IS_DEFINED(c."):-1] in item
+        if condition.startswith("ARRAY_CONTAINS("):
+            name, field = [part.strip() for part in condition[len("ARRAY_CONTAINS("):-1].split(",")]
+            return item.get(field[2:]) in params[name]
+        match = CONDITION_PATTERN.match(condition)
+        if match is None:
+            raise ValueError(f"Unsupported condition: {condition}")
+        field, operator, name = match.groups()
+        return OPERATORS[operator](item.get(field), params[name])
+
+    def project(self, fields, item, score):
+        result = {}
+        for field in fields:
+            expression, _, alias = field.partition(" AS ")
+            if expression.startswith("VectorDistance("):
+                result[alias or "$1"] = score
+            elif expression.startswith("IS_DEFINED(c."):
+                result[alias] = expression[len("IS_DEFINED(c."):-1] in item
+            elif expression.startswith("c."):
+                name = expression[2:]
+                if name in item:
+                    result[alias or name] = item[name]
+            else:
+                raise ValueError(f"Unsupported projection: {field}")
+        return result
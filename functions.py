@@ -1,14 +1,54 @@
-
+import os
+import io
 import json
-import pdfplumber
+import time
 from pathlib import Path
-from docx import Document
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "1"))
+# Prosessipooli kannattaa vasta isoille tiedostoille
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "50"))
+
+# Muuntimet hyväksyvät polun, tavut (esim. uploaded_file.getvalue()) tai tiedostomaisen olion
+def as_stream(source):
+    if isinstance(source, (bytes, bytearray)):
+        return io.BytesIO(source)
+    return source
+
+def read_bytes(source):
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    if isinstance(source, (str, Path)):
+        with open(source, "rb") as f:
+            return f.read()
+    source.seek(0)
+    return source.read()
 
+def source_name(source, name=None):
+    if name:
+        return Path(name).name
+    if isinstance(source, (str, Path)):
+        return Path(source).name
+    return Path(getattr(source, "name", "upload")).name
 
-def docx_to_json(docx_path):
-    doc = Document(docx_path)
+def save_json(data, save_to):
+    # Levylle tallennus on valinnainen; oletuksena tulos palautetaan vain muistissa
+    if save_to:
+        with open(save_to, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+# pdfplumber ja docx tuodaan vasta tarvittaessa, koska ne hidastavat sovelluksen käynnistystä
+def docx_to_json(docx_path, name=None, save_to=None):
+    from docx import Document
+
+    doc = Document(as_stream(docx_path))
     data = {
-        "file_name": Path(docx_path).name,
+        "file_name": source_name(docx_path, name),
         "paragraphs": []
     }
     for i, para in enumerate(doc.paragraphs):
@@ -18,32 +58,104 @@ def docx_to_json(docx_path):
                 "index": i,
                 "text": text
             })
-    with open("output_doc.json", "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    save_json(data, save_to)
     return data
-        
-def pdf_to_json(pdf_path):
+
+def reset_peak_rss():
+    # Linuxissa "5" clear_refsiin nollaa huippulukeman (VmHWM) nykyiseen RSS:ään, jolloin
+    # seuraava lukema on yhden muunnoksen huippu. Rinnakkaiset muunnokset samassa prosessissa
+    # nollaavat saman lukeman, ja poolitilassa työprosessien muisti ei näy tässä.
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    # ru_maxrss (Linuxissa kilotavuina) on koko prosessin elinajan huippu
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def iter_pdf_pages(pdf_path, start=0, end=None):
+    import pdfplumber
+
+    with pdfplumber.open(as_stream(pdf_path)) as pdf:
+        for index in range(start, len(pdf.pages) if end is None else end):
+            page = pdf.pages[index]
+            text = page.extract_text() or ""
+            yield {
+                "page": index + 1,
+                "text": text.strip()
+            }
+            # Vapautetaan sivun välimuisti, jotta muisti ei kasva sivumäärän mukana
+            page.close()
+
+def extract_page_range(args):
+    pdf_path, start, end = args
+    return list(iter_pdf_pages(pdf_path, start, end))
+
+def count_pdf_pages(pdf_path):
+    import pdfplumber
+
+    with pdfplumber.open(as_stream(pdf_path)) as pdf:
+        return len(pdf.pages)
+
+def iter_pdf_pages_parallel(pdf_path, workers=PDF_WORKERS):
+    if workers > 1 and not isinstance(pdf_path, (str, Path)):
+        # Prosesseille välitetään tavut, koska tiedosto-oliota ei voi jakaa
+        pdf_path = read_bytes(pdf_path)
+    page_count = count_pdf_pages(pdf_path) if workers > 1 else 0
+    if page_count < PDF_PARALLEL_MIN_PAGES:
+        yield from iter_pdf_pages(pdf_path)
+        return
+
+    range_size = -(-page_count // (workers * 4))
+    ranges = [
+        (pdf_path, start, min(start + range_size, page_count))
+        for start in range(0, page_count, range_size)
+    ]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for pages in executor.map(extract_page_range, ranges):
+            yield from pages
+
+def pdf_to_json(pdf_path, name=None, save_to=None, workers=PDF_WORKERS):
+    start = time.perf_counter()
+    per_file = reset_peak_rss()
+    pages = list(iter_pdf_pages_parallel(pdf_path, workers))
     data = {
-        "id": Path(pdf_path).name,
-        "content": []
+        "id": source_name(pdf_path, name),
+        "content": "\n\n".join(page["text"] for page in pages if page["text"]),
+        "pages": pages
     }
-    with pdfplumber.open(pdf_path) as pdf:
-        for page_num, page in enumerate(pdf.pages, start=1):
-            text = page.extract_text() or ""
-            data["content"] = text.strip()
-    with open("output_doc.json", "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    elapsed = time.perf_counter() - start
+    peak = peak_rss_mb()
+    print(
+        f"Converted {data['id']}: {len(pages)} pages in {elapsed:.2f}s"
+        + (f", {'peak' if per_file else 'process peak'} RSS {peak:.0f} MB" if peak is not None else "")
+    )
+    save_json(data, save_to)
     return data
 
-def txt_to_json(txt_path):
-    with open(txt_path, 'r', encoding='utf-8') as f:
-        content = f.read()
+def txt_to_json(txt_path, name=None, save_to=None):
+    content = read_bytes(txt_path).decode("utf-8")
     data = {
-        "file_name": Path(txt_path).name,
+        "file_name": source_name(txt_path, name),
         "content": content,
         "lines": [line for line in content.split('\n') if line.strip()]
     }
-    with open("output_doc.json", "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    save_json(data, save_to)
     return data
 
+def load_json(json_path, name=None, save_to=None):
+    data = json.loads(read_bytes(json_path).decode("utf-8"))
+    save_json(data, save_to)
+    return data
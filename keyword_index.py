@@ -0,0 +1,188 @@
+import os
+import re
+import sys
+import math
+import heapq
+import pickle
+from collections import Counter
+from tracing import span
+
+KEYWORD_INDEX_PATH = os.getenv("KEYWORD_INDEX_PATH", "keyword_index.pkl")
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Kummastakin hausta haettavien ehdokkaiden määrä ennen yhdistämistä
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+
+# Säilytetään lomakenumerot ja pykälät (esim. "hr-12", "4.2.1") yhtenä terminä
+TOKEN_PATTERN = re.compile(r"\w[\w\-./]*\w|\w")
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+class BM25Index:
+    # Käänteinen indeksi BM25-pisteytyksellä. Chunkkeja voi lisätä, korvata ja poistaa
+    # yksitellen, joten indeksiä ei tarvitse rakentaa uudelleen jokaisen muutoksen jälkeen.
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.slots = {}
+        self.chunk_ids = []
+        self.doc_lengths = []
+        self.metadata = []
+        self.slot_terms = []
+        self.free_slots = []
+        self.parent_chunks = {}
+        self.total_length = 0
+        self.count = 0
+
+    def add(self, chunk, metadata=None):
+        if chunk["id"] in self.slots:
+            self.remove(chunk["id"])
+
+        metadata = dict(metadata or {}, id=chunk["id"], parent_doc_id=chunk.get("parent_doc_id"))
+        terms = Counter(tokenize(chunk["content"]))
+        length = sum(terms.values())
+        if self.free_slots:
+            slot = self.free_slots.pop()
+            self.chunk_ids[slot] = chunk["id"]
+            self.doc_lengths[slot] = length
+            self.metadata[slot] = metadata
+            self.slot_terms[slot] = tuple(terms)
+        else:
+            slot = len(self.chunk_ids)
+            self.chunk_ids.append(chunk["id"])
+            self.doc_lengths.append(length)
+            self.metadata.append(metadata)
+            self.slot_terms.append(tuple(terms))
+
+        for term, frequency in terms.items():
+            self.postings.setdefault(term, {})[slot] = frequency
+        self.slots[chunk["id"]] = slot
+        self.parent_chunks.setdefault(metadata["parent_doc_id"], set()).add(chunk["id"])
+        self.total_length += length
+        self.count += 1
+
+    def remove(self, chunk_id):
+        slot = self.slots.pop(chunk_id, None)
+        if slot is None:
+            return
+        for term in self.slot_terms[slot]:
+            entries = self.postings[term]
+            del entries[slot]
+            if not entries:
+                del self.postings[term]
+        parent = self.metadata[slot].get("parent_doc_id")
+        self.parent_chunks.get(parent, set()).discard(chunk_id)
+        self.total_length -= self.doc_lengths[slot]
+        self.count -= 1
+        self.chunk_ids[slot] = None
+        self.metadata[slot] = None
+        self.slot_terms[slot] = ()
+        self.doc_lengths[slot] = 0
+        self.free_slots.append(slot)
+
+    def sync_document(self, parent_doc_id, chunks, metadata_fields):
+        # Korvaa dokumentin chunkit ja poistaa ne, joita uusi versio ei enää tuota
+        current = {chunk["id"] for chunk in chunks}
+        for chunk_id in self.parent_chunks.get(parent_doc_id, set()) - current:
+            self.remove(chunk_id)
+        for chunk in chunks:
+            self.add(chunk, {field: chunk.get(field) for field in metadata_fields})
+
+    def search(self, query_text, top_k, filters=None):
+        with span("keyword_search"):
+            return self.score(query_text, top_k, filters)
+
+    def score(self, query_text, top_k, filters=None):
+        from retrieval import matches_filters
+
+        if not self.count:
+            return []
+        average_length = self.total_length / self.count
+        scores = {}
+        for term in set(tokenize(query_text)):
+            entries = self.postings.get(term)
+            if not entries:
+                continue
+            idf = math.log(1 + (self.count - len(entries) + 0.5) / (len(entries) + 0.5))
+            for slot, frequency in entries.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[slot] / average_length)
+                scores[slot] = scores.get(slot, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+        if filters:
+            scores = {slot: score for slot, score in scores.items() if matches_filters(self.metadata[slot], filters)}
+
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [
+            dict(self.metadata[slot], bm25=score)
+            for slot, score in best
+        ]
+
+    def save(self, path=KEYWORD_INDEX_PATH):
+        with open(path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_index(path=KEYWORD_INDEX_PATH):
+    if not os.path.exists(path):
+        return BM25Index()
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+def reciprocal_rank_fusion(result_lists, top_k, k=RRF_K):
+    fused = {}
+    for results in result_lists:
+        for rank, r in enumerate(results, start=1):
+            entry = fused.setdefault(r["id"], dict(r, rrf_score=0.0))
+            entry.update({key: value for key, value in r.items() if key not in entry})
+            entry["rrf_score"] += 1 / (k + rank)
+    return sorted(fused.values(), key=lambda r: r["rrf_score"], reverse=True)[:top_k]
+
+class HybridRetriever:
+    # Vektorihaku ja BM25 haetaan ylimitoitettuna ja yhdistetään RRF:llä pienemmäksi top-k:ksi
+    def __init__(self, vector_retriever, keyword_index, candidates=HYBRID_CANDIDATES):
+        self.vector_retriever = vector_retriever
+        self.keyword_index = keyword_index
+        self.candidates = candidates
+
+    def search(self, query_embedding, top_k, query_text=None, filters=None):
+        vector_results = self.vector_retriever.search(query_embedding, max(top_k, self.candidates), filters=filters)
+        if not query_text:
+            return vector_results[:top_k]
+        keyword_results = [
+            dict(r, keyword_rank=rank)
+            for rank, r in enumerate(self.keyword_index.search(query_text, self.candidates, filters), start=1)
+        ]
+        return reciprocal_rank_fusion([vector_results, keyword_results], top_k)
+
+    def search_batch(self, query_embeddings, top_k, query_texts=None, filters=None):
+        query_texts = query_texts or [None] * len(query_embeddings)
+        vector_lists = self.vector_retriever.search_batch(query_embeddings, max(top_k, self.candidates), filters=filters)
+        results = []
+        for vector_results, query_text in zip(vector_lists, query_texts):
+            if not query_text:
+                results.append(vector_results[:top_k])
+                continue
+            keyword_results = [
+                dict(r, keyword_rank=rank)
+                for rank, r in enumerate(self.keyword_index.search(query_text, self.candidates, filters), start=1)
+            ]
+            results.append(reciprocal_rank_fusion([vector_results, keyword_results], top_k))
+        return results
+
+    def document_versions(self, parent_doc_ids):
+        return self.vector_retriever.document_versions(parent_doc_ids)
+
+if __name__ == "__main__":
+
+    from cosmosdb import chunk_document, list_doc_files, load_documents, folder
+    from document_store import document_record, join_document
+    from retrieval import METADATA_FIELDS
+
+    docs_folder = sys.argv[1] if len(sys.argv) > 1 else folder
+
+    index = load_index()
+    for doc in load_documents(list_doc_files(docs_folder)):
+        record = document_record(doc)
+        index.sync_document(doc["id"], [join_document(chunk, record) for chunk in chunk_document(doc)], METADATA_FIELDS)
+    index.save()
+    print(f"Keyword index: {index.count} chunks, {len(index.postings)} terms -> {KEYWORD_INDEX_PATH}")
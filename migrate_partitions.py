@@ -0,0 +1,63 @@
+import os
+import sys
+from itertools import islice
+from cosmosdb import create_cosmos_client, ensure_container, upsert_chunks
+from partitioning import PARTITION_KEY_FIELD, PARTITION_STRATEGY, partition_key_for
+
+# Kopioi chunkit vanhasta kontista uuteen, jonka partitioavain on /partitionKey.
+# Partitioavainta ei voi vaihtaa olemassa olevaan konttiin, joten siirto tehdään kopiona;
+# kun kohde on tarkistettu, sovellus vaihdetaan käyttämään sitä (COSMOS_CONTAINER ja
+# COSMOS_PARTITION_KEY=/partitionKey) ja vanha kontti poistetaan käsin.
+# Käyttö: python migrate_partitions.py <kohdekontti> [--batch N]
+
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "500"))
+SYSTEM_FIELDS = ("_rid", "_self", "_etag", "_attachments", "_ts")
+
+def rehome(item):
+    item = {key: value for key, value in item.items() if key not in SYSTEM_FIELDS}
+    item[PARTITION_KEY_FIELD] = partition_key_for(item)
+    return item
+
+def migrate(source, target, batch_size=MIGRATION_BATCH_SIZE):
+    totals = {"read": 0, "written": 0, "failed": 0, "throttled": 0, "request_charge": 0.0, "partitions": {}}
+    items = (rehome(item) for item in source.read_all_items())
+
+    # Luetaan ja kirjoitetaan erissä, jotta koko kontti ei ole muistissa kerralla
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            break
+        stats = upsert_chunks(target, batch)
+        totals["read"] += len(batch)
+        for key in ("written", "failed", "throttled", "request_charge"):
+            totals[key] += stats[key]
+        for item in batch:
+            value = item[PARTITION_KEY_FIELD]
+            totals["partitions"][value] = totals["partitions"].get(value, 0) + 1
+        print(f"Migrated {totals['read']} items ({totals['failed']} failed)")
+    return totals
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    batch_size = MIGRATION_BATCH_SIZE
+    if "--batch" in args:
+        index = args.index("--batch")
+        batch_size = int(args[index + 1])
+        del args[index:index + 2]
+    if not args:
+        sys.exit("Usage: python migrate_partitions.py <target container> [--batch N]")
+
+    cosmos_client = create_cosmos_client()
+    database = cosmos_client.get_database_client(os.getenv("COSMOS_DATABASE"))
+    source = database.get_container_client(os.getenv("COSMOS_CONTAINER"))
+    target = ensure_container(database, args[0], partition_key_path=f"/{PARTITION_KEY_FIELD}")
+
+    totals = migrate(source, target, batch_size)
+    print(
+        f"Read {totals['read']}, wrote {totals['written']}, failed {totals['failed']}, "
+        f"{totals['throttled']} throttled, {totals['request_charge']:.1f} RU total"
+    )
+    print(f"Partitions by {PARTITION_STRATEGY}:")
+    for value, count in sorted(totals["partitions"].items(), key=lambda entry: -entry[1]):
+        print(f"  {value}: {count}")
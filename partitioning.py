@@ -0,0 +1,28 @@
+import os
+
+# Chunkit partitioidaan synteettisellä partitionKey-kentällä, jonka arvo tulee
+# PARTITION_STRATEGY-kentästä (esim. company tai documentType). Kun haun rajaus
+# kertoo tämän kentän arvon, kysely voidaan ohjata yhteen partitioon.
+COSMOS_PARTITION_KEY = os.getenv("COSMOS_PARTITION_KEY", "/id")
+PARTITION_STRATEGY = os.getenv("PARTITION_STRATEGY", "company")
+PARTITION_KEY_FIELD = "partitionKey"
+
+def partition_key_for(doc):
+    return str(doc.get(PARTITION_STRATEGY) or "unknown")
+
+def partition_key_value(item):
+    return item[COSMOS_PARTITION_KEY.lstrip("/")]
+
+def uses_partition_strategy():
+    return COSMOS_PARTITION_KEY == f"/{PARTITION_KEY_FIELD}"
+
+def partition_scope(filters):
+    # Palauttaa partitioavaimet joihin haku voidaan rajata, tai None jos kaikki on käytävä läpi
+    if not uses_partition_strategy():
+        return None
+    value = (filters or {}).get(PARTITION_STRATEGY)
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple, set)):
+        return [str(v) for v in value]
+    return [str(value)]
@@ -0,0 +1,43 @@
+import re
+import threading
+
+# Azure OpenAI välimuistittaa pyynnön alun (vähintään 1024 tokenia), kun se on merkki
+# merkiltä sama kuin aiemmassa pyynnössä. Siksi promptit rakennetaan niin, että staattiset
+# ohjeet tulevat ensin tiivistettynä ja kysymys, dokumentti ja haetut tekstit vasta lopussa.
+
+def minify_prompt(text):
+    # Poistaa rivien sisennykset ja ylimääräiset tyhjät rivit, jotta etuliite pysyy vakaana ja lyhyenä
+    lines = [line.strip() for line in text.strip().splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+
+class PromptCacheStats:
+    # Kutsukohtaiset syöte- ja välimuistitokenit promptin nimen mukaan
+    def __init__(self):
+        self.prompts = {}
+        self.lock = threading.Lock()
+
+    def record(self, prompt_name, usage):
+        details = getattr(usage, "input_tokens_details", None)
+        result = {
+            "input_tokens": usage.input_tokens,
+            "output_tokens": usage.output_tokens,
+            "cached_tokens": getattr(details, "cached_tokens", 0) or 0
+        }
+        with self.lock:
+            totals = self.prompts.setdefault(prompt_name, {"calls": 0, "input_tokens": 0, "cached_tokens": 0})
+            totals["calls"] += 1
+            totals["input_tokens"] += result["input_tokens"]
+            totals["cached_tokens"] += result["cached_tokens"]
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {
+                name: dict(totals, cached_ratio=totals["cached_tokens"] / totals["input_tokens"] if totals["input_tokens"] else 0.0)
+                for name, totals in self.prompts.items()
+            }
+
+prompt_cache_stats = PromptCacheStats()
+
+def record_usage(prompt_name, usage):
+    return prompt_cache_stats.record(prompt_name, usage)
@@ -0,0 +1,429 @@
+import os
+import time
+import uuid
+import random
+import asyncio
+import threading
+import functools
+import contextvars
+from contextlib import aclosing, contextmanager
+from tracing import record, request_charge_hook
+
+# Prosessin yhteinen aikataulutus Azure OpenAI- ja Cosmos-kutsuille: mallikohtaiset token bucketit
+# (pyynnöt ja tokenit minuutissa), RU-budjetti Cosmokselle ja pääsynvalvonta, joka jakaa
+# vuorot reilusti istuntojen kesken. Kun jono tai budjetti on täynnä, kutsu saa BusyErrorin
+# eikä jää odottamaan aikakatkaisua.
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "300"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "50000"))
+# Mallikohtaiset poikkeukset, esim. "gpt-4.1=300:50000,text-embedding-ada-002=1200:240000"
+OPENAI_LIMITS = os.getenv("OPENAI_LIMITS", "")
+COSMOS_RU_PER_SEC = float(os.getenv("COSMOS_RU_PER_SEC", "400"))
+# Samanaikaiset chat-/dokumenttipyynnöt ja jonon enimmäispituus
+MAX_ACTIVE_REQUESTS = int(os.getenv("MAX_ACTIVE_REQUESTS", "8"))
+MAX_QUEUED_REQUESTS = int(os.getenv("MAX_QUEUED_REQUESTS", "32"))
+ADMISSION_TIMEOUT = float(os.getenv("ADMISSION_TIMEOUT", "20"))
+# Asynkroninen jonottaja tarkistaa vuoronsa tällä välillä
+ADMISSION_POLL_INTERVAL = 0.02
+# Jos budjettiin joutuisi odottamaan tätä pidempään, kutsu hylätään heti
+BUDGET_MAX_WAIT = float(os.getenv("BUDGET_MAX_WAIT", "15"))
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "4"))
+RETRY_BASE_DELAY = 0.5
+RETRY_JITTER = 0.2
+BUSY_MESSAGE = "The service is busy right now. Please try again in a moment."
+
+_session_id = contextvars.ContextVar("session_id", default="default")
+
+class BusyError(Exception):
+    def __init__(self, retry_after=None, message=BUSY_MESSAGE):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+@contextmanager
+def session_scope(session_id):
+    # Reilu jonotus tehdään istunnoittain; app.py asettaa Streamlit-istunnon tunnisteen
+    token = _session_id.set(session_id or uuid.uuid4().hex)
+    try:
+        yield
+    finally:
+        _session_id.reset(token)
+
+def estimate_tokens(payload):
+    # Azure arvioi pyynnön tokenit merkkimäärästä ennen kutsua; sama karkea arvio riittää tässä
+    if isinstance(payload, str):
+        return len(payload) // 4 + 1
+    return sum(estimate_tokens(text) for text in payload)
+
+def is_throttled(error):
+    return getattr(error, "status_code", None) == 429
+
+def retry_after_seconds(error, default=1.0):
+    # Cosmos: x-ms-retry-after-ms, OpenAI: retry-after-ms tai retry-after (sekunteja)
+    headers = getattr(error, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    for name, scale in (("x-ms-retry-after-ms", 1000), ("retry-after-ms", 1000), ("retry-after", 1)):
+        value = headers.get(name)
+        if value:
+            try:
+                return float(value) / scale
+            except ValueError:
+                continue
+    return default
+
+def backoff(attempt, retry_after=None):
+    delay = retry_after if retry_after is not None else RETRY_BASE_DELAY * 2 ** attempt
+    return delay + random.uniform(0, delay * RETRY_JITTER)
+
+class TokenBucket:
+    # Varauspohjainen bucket: saldo voi mennä negatiiviseksi, jolloin varaaja odottaa vuoroaan.
+    # Näin odotusajat ovat varausjärjestyksessä ilman erillistä jonoa.
+    def __init__(self, rate_per_sec, capacity):
+        self.rate = rate_per_sec
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, max_wait=None):
+        # Palauttaa odotusajan sekunteina; liian pitkä odotus perutaan BusyErrorilla
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self.refill()
+            wait = max(0.0, (amount - self.tokens) / self.rate, self.paused_until - self.updated)
+            if max_wait is not None and wait > max_wait:
+                raise BusyError(retry_after=wait)
+            self.tokens -= amount
+            return wait
+
+    def refund(self, amount):
+        self.adjust(-amount)
+
+    def adjust(self, amount):
+        # Toteutunut kulutus arvion päälle (tai hyvitys, jos amount < 0)
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+    def pause(self, seconds):
+        # 429:n retry-after pysäyttää kaikki saman budjetin käyttäjät, ei vain yrittänyttä kutsua
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def wait_time(self):
+        with self.lock:
+            self.refill()
+            return max(0.0, -self.tokens / self.rate, self.paused_until - self.updated)
+
+def parse_limits(text):
+    limits = {}
+    for entry in filter(None, (part.strip() for part in text.split(","))):
+        model, values = entry.split("=")
+        rpm, tpm = values.split(":")
+        limits[model.strip()] = (int(rpm), int(tpm))
+    return limits
+
+class Scheduler:
+    def __init__(self, rpm=OPENAI_RPM, tpm=OPENAI_TPM, limits=OPENAI_LIMITS, ru_per_sec=COSMOS_RU_PER_SEC,
+                 max_active=MAX_ACTIVE_REQUESTS, max_queued=MAX_QUEUED_REQUESTS, admission_timeout=ADMISSION_TIMEOUT):
+        self.default_limits = (rpm, tpm)
+        self.limits = parse_limits(limits)
+        self.buckets = {}
+        self.ru = TokenBucket(ru_per_sec, ru_per_sec)
+        # Kyselyn RU-arvio ennen kutsua; päivittyy toteutuneista kuluista
+        self.ru_estimate = 10.0
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.admission_timeout = admission_timeout
+        self.active = {}
+        self.waiting = []
+        self.sequence = 0
+        self.last_served = {}
+        self.stats_counts = {"admitted": 0, "rejected": 0, "throttled": 0, "retries": 0}
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+
+    def model_buckets(self, model):
+        with self.lock:
+            if model not in self.buckets:
+                rpm, tpm = self.limits.get(model, self.default_limits)
+                self.buckets[model] = (TokenBucket(rpm / 60, max(1, rpm // 6)), TokenBucket(tpm / 60, max(1, tpm // 6)))
+            return self.buckets[model]
+
+    def count(self, name):
+        with self.lock:
+            self.stats_counts[name] += 1
+
+    # --- Pääsynvalvonta ---
+
+    def next_ticket(self):
+        # Vuoro annetaan istunnolle, jolla on vähiten aktiivisia pyyntöjä ja joka on palveltu
+        # pisimpään sitten; saman istunnon pyynnöt saapumisjärjestyksessä
+        return min(self.waiting, key=lambda ticket: (
+            self.active.get(ticket[1], 0),
+            self.last_served.get(ticket[1], 0),
+            ticket[0]
+        ))
+
+    def enqueue(self, session):
+        # Kutsutaan lukko varattuna
+        if len(self.waiting) >= self.max_queued:
+            self.stats_counts["rejected"] += 1
+            raise BusyError(retry_after=self.admission_timeout)
+        self.sequence += 1
+        ticket = (self.sequence, session)
+        self.waiting.append(ticket)
+        return ticket
+
+    def is_turn(self, ticket):
+        return sum(self.active.values()) < self.max_active and self.next_ticket() == ticket
+
+    def withdraw(self, ticket, rejected=True):
+        self.waiting.remove(ticket)
+        if rejected:
+            self.stats_counts["rejected"] += 1
+        self.condition.notify_all()
+
+    def admit_ticket(self, ticket):
+        session = ticket[1]
+        self.waiting.remove(ticket)
+        self.active[session] = self.active.get(session, 0) + 1
+        self.last_served[session] = ticket[0]
+        if len(self.last_served) > 1000:
+            waiting = {s for _, s in self.waiting}
+            self.last_served = {s: served for s, served in self.last_served.items() if s in self.active or s in waiting}
+        self.stats_counts["admitted"] += 1
+        self.condition.notify_all()
+
+    def acquire(self, session=None):
+        session = session or _session_id.get()
+        start = time.monotonic()
+        with self.condition:
+            ticket = self.enqueue(session)
+            deadline = start + self.admission_timeout
+            while not self.is_turn(ticket):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.withdraw(ticket)
+                    raise BusyError(retry_after=self.admission_timeout)
+                self.condition.wait(remaining)
+            self.admit_ticket(ticket)
+        record("admission", time.monotonic() - start, session=session)
+        return session
+
+    async def aacquire(self, session=None):
+        # Jonotus tapahtumasilmukassa: to_thread(acquire) varaisi executorin säikeen koko odotuksen ajaksi,
+        # ja samaa executoria tarvitsevat jo päästetyt pyynnöt jäisivät jumiin jonottajien taakse
+        session = session or _session_id.get()
+        start = time.monotonic()
+        with self.lock:
+            ticket = self.enqueue(session)
+        deadline = start + self.admission_timeout
+        try:
+            while True:
+                with self.lock:
+                    if self.is_turn(ticket):
+                        self.admit_ticket(ticket)
+                        break
+                    if time.monotonic() >= deadline:
+                        self.withdraw(ticket)
+                        raise BusyError(retry_after=self.admission_timeout)
+                await asyncio.sleep(ADMISSION_POLL_INTERVAL)
+        except asyncio.CancelledError:
+            with self.lock:
+                self.withdraw(ticket, rejected=False)
+            raise
+        record("admission", time.monotonic() - start, session=session)
+        return session
+
+    def release(self, session):
+        with self.condition:
+            self.active[session] -= 1
+            if not self.active[session]:
+                del self.active[session]
+            self.condition.notify_all()
+
+    @contextmanager
+    def admit(self, session=None):
+        session = self.acquire(session)
+        try:
+            yield
+        finally:
+            self.release(session)
+
+    # --- Azure OpenAI ---
+
+    def reserve_openai(self, model, tokens, max_wait):
+        requests, token_bucket = self.model_buckets(model)
+        wait = requests.reserve(1, max_wait)
+        try:
+            return max(wait, token_bucket.reserve(tokens, max_wait))
+        except BusyError:
+            requests.refund(1)
+            self.count("rejected")
+            raise
+
+    def check_openai_budget(self, model, max_wait=BUDGET_MAX_WAIT):
+        # Monivaiheiselle työlle tehdään yksi tarkistus alussa ja sen kutsut odottavat budjettia
+        # (max_wait=None), ettei jo maksettuja osavaiheita heitetä pois kesken työn
+        wait = max(bucket.wait_time() for bucket in self.model_buckets(model))
+        if wait > max_wait:
+            self.count("rejected")
+            raise BusyError(retry_after=wait)
+
+    def throttled(self, model, error, attempt):
+        self.count("throttled")
+        if attempt >= RATE_LIMIT_MAX_RETRIES:
+            raise BusyError(retry_after=retry_after_seconds(error, None)) from error
+        self.count("retries")
+        delay = backoff(attempt, retry_after_seconds(error, None))
+        for bucket in self.model_buckets(model):
+            bucket.pause(delay)
+        return delay
+
+    def openai_call(self, model, tokens, call, max_wait=BUDGET_MAX_WAIT):
+        for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+            time.sleep(self.reserve_openai(model, tokens, max_wait))
+            try:
+                return call()
+            except Exception as e:
+                if not is_throttled(e):
+                    raise
+                time.sleep(self.throttled(model, e, attempt))
+
+    async def aopenai_call(self, model, tokens, call, max_wait=BUDGET_MAX_WAIT):
+        for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+            await asyncio.sleep(self.reserve_openai(model, tokens, max_wait))
+            try:
+                return await call()
+            except Exception as e:
+                if not is_throttled(e):
+                    raise
+                await asyncio.sleep(self.throttled(model, e, attempt))
+
+    # --- Cosmos DB ---
+
+    def settle_ru(self, estimate, charges):
+        actual = sum(charges)
+        self.ru.adjust(actual - estimate)
+        if actual:
+            with self.lock:
+                self.ru_estimate = 0.8 * self.ru_estimate + 0.2 * actual
+
+    def cosmos_throttled(self, error, attempt):
+        self.count("throttled")
+        if attempt >= RATE_LIMIT_MAX_RETRIES:
+            raise BusyError(retry_after=retry_after_seconds(error)) from error
+        self.count("retries")
+        delay = backoff(attempt, retry_after_seconds(error))
+        self.ru.pause(delay)
+        return delay
+
+    def cosmos_call(self, call, charges=None, max_wait=BUDGET_MAX_WAIT):
+        # call(hook) ajaa Cosmos-kutsun ja välittää hookin response_hook-parametrina
+        for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+            estimate = self.ru_estimate
+            time.sleep(self.ru.reserve(estimate, max_wait))
+            used = []
+            try:
+                return call(request_charge_hook(used))
+            except Exception as e:
+                if not is_throttled(e):
+                    raise
+                time.sleep(self.cosmos_throttled(e, attempt))
+            finally:
+                self.settle_ru(estimate, used)
+                if charges is not None:
+                    charges.extend(used)
+
+    async def acosmos_call(self, call, charges=None, max_wait=BUDGET_MAX_WAIT):
+        for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+            estimate = self.ru_estimate
+            await asyncio.sleep(self.ru.reserve(estimate, max_wait))
+            used = []
+            try:
+                return await call(request_charge_hook(used))
+            except Exception as e:
+                if not is_throttled(e):
+                    raise
+                await asyncio.sleep(self.cosmos_throttled(e, attempt))
+            finally:
+                self.settle_ru(estimate, used)
+                if charges is not None:
+                    charges.extend(used)
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.stats_counts,
+                "active": sum(self.active.values()),
+                "queued": len(self.waiting),
+                "ru_wait": self.ru.wait_time()
+            }
+
+scheduler = Scheduler()
+
+def create_response(client, max_wait=BUDGET_MAX_WAIT, **kwargs):
+    # TPM-varaus kattaa syötteen arvion ja max_output_tokensin, kuten Azuren oma rajoitin
+    tokens = estimate_tokens(kwargs["input"]) + kwargs.get("max_output_tokens", 0)
+    return scheduler.openai_call(kwargs["model"], tokens, lambda: client.responses.create(**kwargs), max_wait)
+
+def create_embeddings(client, model, input, max_wait=BUDGET_MAX_WAIT):
+    return scheduler.openai_call(model, estimate_tokens(input), lambda: client.embeddings.create(model=model, input=input), max_wait)
+
+async def acreate_response(client, max_wait=BUDGET_MAX_WAIT, **kwargs):
+    tokens = estimate_tokens(kwargs["input"]) + kwargs.get("max_output_tokens", 0)
+    return await scheduler.aopenai_call(kwargs["model"], tokens, lambda: client.responses.create(**kwargs), max_wait)
+
+async def acreate_embeddings(client, model, input, max_wait=BUDGET_MAX_WAIT):
+    return await scheduler.aopenai_call(model, estimate_tokens(input), lambda: client.embeddings.create(model=model, input=input), max_wait)
+
+def query_items(container, charges=None, max_wait=BUDGET_MAX_WAIT, **kwargs):
+    # Tulokset luetaan listaksi budjetin sisällä, jotta sivutuksen RU-kulut kirjautuvat samalle kutsulle
+    return scheduler.cosmos_call(lambda hook: list(container.query_items(response_hook=hook, **kwargs)), charges, max_wait)
+
+async def aquery_items(container, charges=None, max_wait=BUDGET_MAX_WAIT, **kwargs):
+    async def run(hook):
+        return [item async for item in container.query_items(response_hook=hook, **kwargs)]
+    return await scheduler.acosmos_call(run, charges, max_wait)
+
+def busy_events(error):
+    yield {"type": "delta", "text": str(error)}
+    yield {"type": "done", "response": str(error), "sources": [], "usage": None, "busy": True}
+
+def admitted_stream(func):
+    # Koristelija striimaaville pyynnöille: pyyntö odottaa vuoroaan tai saa heti busy-vastauksen
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            session = scheduler.acquire()
+        except BusyError as e:
+            yield from busy_events(e)
+            return
+        try:
+            yield from func(*args, **kwargs)
+        finally:
+            scheduler.release(session)
+    return wrapper
+
+def admitted_astream(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            session = await scheduler.aacquire()
+        except BusyError as e:
+            for event in busy_events(e):
+                yield event
+            return
+        try:
+            async with aclosing(func(*args, **kwargs)) as events:
+                async for event in events:
+                    yield event
+        finally:
+            scheduler.release(session)
+    return wrapper
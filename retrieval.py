@@ -0,0 +1,314 @@
+import os
+import sys
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from partitioning import partition_scope
+from tracing import span
+from rate_limit import query_items
+from document_store import DOCUMENT_TYPE, JOINED_FIELDS, get_document_cache, join_document
+
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "cosmos")
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "local_index")
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "8"))
+# Hybridihaku (BM25 + vektori, RRF) otetaan käyttöön kun avainsanaindeksi on rakennettu
+RETRIEVAL_HYBRID = os.getenv("RETRIEVAL_HYBRID", "0") == "1"
+# Vektoriosuman vähimmäissamankaltaisuus; retrieval_tuning.py suosittelee arvon golden setin perusteella
+RELEVANCE_THRESHOLD = float(os.getenv("RELEVANCE_THRESHOLD", "0.75"))
+# Pelkällä avainsanalla löytyneet osumat hyväksytään tämän BM25-pisteen yläpuolella
+KEYWORD_MIN_SCORE = float(os.getenv("KEYWORD_MIN_SCORE", "3.0"))
+
+# Chunkin omat kentät; otsikko ja lähde liitetään dokumenttitietueesta (ks. document_store)
+CHUNK_FIELDS = ["id", "parent_doc_id", "version", "content"]
+# Kentät jotka molemmat backendit palauttavat jokaiselle osumalle
+RESULT_FIELDS = CHUNK_FIELDS + JOINED_FIELDS
+# Kentät joilla hakua voi rajata; ne ovat indeksoituja Cosmosissa (ks. CHUNK_INDEXING_POLICY)
+FILTER_FIELDS = ["status", "company", "documentType", "version"]
+METADATA_FIELDS = RESULT_FIELDS + ["status", "company", "documentType", "effectiveDate"]
+
+# Oletusrajaus, esim. RETRIEVAL_STATUS=active jättää luonnokset ja korvatut versiot pois
+DEFAULT_FILTERS = {"status": os.getenv("RETRIEVAL_STATUS")} if os.getenv("RETRIEVAL_STATUS") else {}
+
+def build_filter_clause(filters):
+    # filters: {"status": "active", "company": ["NordSure", ...], "in_force_on": "2025-01-01"}
+    conditions = []
+    parameters = []
+    for field, value in (filters or {}).items():
+        if value is None:
+            continue
+        if field == "in_force_on":
+            conditions.append("c.effectiveDate <= @in_force_on")
+            parameters.append({ "name": "@in_force_on", "value": value })
+        elif field in FILTER_FIELDS:
+            name = f"@f_{field}"
+            if isinstance(value, (list, tuple, set)):
+                conditions.append(f"ARRAY_CONTAINS({name}, c.{field})")
+                value = list(value)
+            else:
+                conditions.append(f"c.{field} = {name}")
+            parameters.append({ "name": name, "value": value })
+        else:
+            raise ValueError(f"Unknown retrieval filter: {field}")
+    return " AND ".join(conditions), parameters
+
+def matches_filters(item, filters):
+    for field, value in (filters or {}).items():
+        if value is None:
+            continue
+        if field == "in_force_on":
+            if not item.get("effectiveDate") or item["effectiveDate"] > value:
+                return False
+        elif isinstance(value, (list, tuple, set)):
+            if item.get(field) not in value:
+                return False
+        elif item.get(field) != value:
+            return False
+    return True
+
+def vector_query(query_embedding, top_k, filters=None):
+    # Otsikko ja lähde valitaan myös chunkista: vanhan mallin chunkeissa ne ovat vielä mukana,
+    # ja join_document käyttää niitä jos dokumenttitietuetta ei ole
+    fields = ",\n                ".join(f"c.{field}" for field in RESULT_FIELDS)
+    where, parameters = build_filter_clause(filters)
+    # Vain dokumenttitietueilla on type-kenttä; ehto käyttää /type/?-indeksiä, toisin kuin
+    # IS_DEFINED(c.embedding), jonka polku on jätetty indeksin ulkopuolelle
+    where = " AND ".join(["NOT IS_DEFINED(c.type)"] + ([where] if where else []))
+    query = f"""
+            SELECT TOP {top_k}
+                {fields},
+                VectorDistance(c.embedding, @q) AS score
+            FROM c
+            WHERE {where}
+            ORDER BY VectorDistance(c.embedding, @q)
+            """
+    return query, [{ "name": "@q", "value": query_embedding }] + parameters
+
+def merge_top_k(result_lists, top_k):
+    # VectorDistance palauttaa kosinisamankaltaisuuden, joten suurin piste on paras
+    merged = [r for results in result_lists for r in results]
+    return sorted(merged, key=lambda r: r["score"], reverse=True)[:top_k]
+
+class CosmosRetriever:
+    def __init__(self, container, documents=None):
+        self.container = container
+        self.documents = documents or get_document_cache()
+        self.feed_ranges = None
+
+    def query_partitions(self, query, parameters, targets, charges):
+        # Jokainen kohde on {"partition_key": ...} tai {"feed_range": ...}; kyselyt ajetaan rinnakkain
+        def run(target):
+            return query_items(
+                self.container,
+                charges,
+                query=query,
+                parameters=parameters,
+                **target
+            )
+
+        if len(targets) == 1:
+            return [run(targets[0])]
+        with ThreadPoolExecutor(max_workers=min(SEARCH_WORKERS, len(targets))) as executor:
+            return list(executor.map(run, targets))
+
+    def search(self, query_embedding, top_k, query_text=None, filters=None):
+        query, parameters = vector_query(query_embedding, top_k, filters)
+
+        # Kun rajaus kertoo partitioavaimen, kysely menee vain niihin partitioihin
+        scope = partition_scope(filters)
+        if scope is not None:
+            targets = [{ "partition_key": value } for value in scope]
+        else:
+            if self.feed_ranges is None:
+                self.feed_ranges = list(self.container.read_feed_ranges())
+            targets = [{ "feed_range": feed_range } for feed_range in self.feed_ranges]
+
+        with span("retrieve", backend="cosmos", partitions=len(targets)) as attrs:
+            charges = []
+            results = merge_top_k(self.query_partitions(query, parameters, targets, charges), top_k)
+            results = self.documents.join(self.container, results, charges)
+            attrs["results"] = len(results)
+            attrs["request_charge"] = sum(charges)
+        return results
+
+    def search_batch(self, query_embeddings, top_k, query_texts=None, filters=None):
+        if len(query_embeddings) <= 1:
+            return [self.search(query_embedding, top_k, filters=filters) for query_embedding in query_embeddings]
+        with ThreadPoolExecutor(max_workers=min(SEARCH_WORKERS, len(query_embeddings))) as executor:
+            return list(executor.map(lambda query_embedding: self.search(query_embedding, top_k, filters=filters), query_embeddings))
+
+    def document_versions(self, parent_doc_ids):
+        results = query_items(
+            self.container,
+            query="""
+                SELECT DISTINCT c.parent_doc_id, c.version
+                FROM c
+                WHERE ARRAY_CONTAINS(@ids, c.parent_doc_id)
+                """,
+            parameters=[{ "name": "@ids", "value": list(parent_doc_ids) }],
+            enable_cross_partition_query=True
+        )
+        return collect_versions(results)
+
+class LocalVectorIndex:
+    # Muistikartoitettu float32-matriisi normalisoiduista upotuksista + metadata.jsonl,
+    # jolloin kosinisamankaltaisuus on pelkkä pistetulo
+    def __init__(self, path=LOCAL_INDEX_PATH):
+        import numpy as np
+
+        self.path = Path(path)
+        with open(self.path / "index.json", "r", encoding="utf-8") as f:
+            info = json.load(f)
+        self.embeddings = np.memmap(
+            self.path / "embeddings.f32",
+            dtype=np.float32,
+            mode="r",
+            shape=(info["count"], info["dim"])
+        )
+        with open(self.path / "metadata.jsonl", "r", encoding="utf-8") as f:
+            self.metadata = [json.loads(line) for line in f]
+        # Suodatuskentät sarakkeina, jotta rajaus on yksi vektoroitu vertailu eikä Python-silmukka
+        self.columns = {field: np.array([item.get(field) for item in self.metadata], dtype=object) for field in FILTER_FIELDS}
+        self.effective_dates = np.array([item.get("effectiveDate") or "" for item in self.metadata], dtype=str)
+
+    def filter_mask(self, filters):
+        import numpy as np
+
+        mask = np.ones(len(self.metadata), dtype=bool)
+        for field, value in filters.items():
+            if value is None:
+                continue
+            if field == "in_force_on":
+                mask &= (self.effective_dates != "") & (self.effective_dates <= value)
+            elif field not in self.columns:
+                raise ValueError(f"Unknown retrieval filter: {field}")
+            elif isinstance(value, (list, tuple, set)):
+                mask &= np.logical_or.reduce([self.columns[field] == v for v in value]) if value else False
+            else:
+                mask &= self.columns[field] == value
+        return mask
+
+    def search(self, query_embedding, top_k, query_text=None, filters=None):
+        return self.search_batch([query_embedding], top_k, filters=filters)[0]
+
+    def search_batch(self, query_embeddings, top_k, query_texts=None, filters=None):
+        with span("retrieve", backend="local", queries=len(query_embeddings)):
+            return self.score_batch(query_embeddings, top_k, filters)
+
+    def score_batch(self, query_embeddings, top_k, filters=None):
+        import numpy as np
+
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+        # Koko matriisi pisteytetään ja rajatut rivit ohitetaan -inf-pisteellä; rivien kopiointi
+        # memmapista rajauksen mukaan olisi hitaampaa kuin pelkkä pistetulo
+        scores = queries @ self.embeddings.T
+        if filters:
+            mask = self.filter_mask(filters)
+            scores[:, ~mask] = -np.inf
+            top_k = min(top_k, int(mask.sum()))
+        else:
+            top_k = min(top_k, scores.shape[1])
+        if top_k == 0:
+            return [[] for _ in query_embeddings]
+
+        top = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        results = []
+        for row, candidates in zip(scores, top):
+            ordered = candidates[np.argsort(-row[candidates])]
+            results.append([
+                dict(self.metadata[i], score=float(row[i]))
+                for i in ordered
+            ])
+        return results
+
+    def document_versions(self, parent_doc_ids):
+        wanted = set(parent_doc_ids)
+        return collect_versions(item for item in self.metadata if item["parent_doc_id"] in wanted)
+
+def is_relevant(r, threshold):
+    if r.get("score") is not None and r["score"] >= threshold:
+        return True
+    return r.get("bm25", 0.0) >= KEYWORD_MIN_SCORE
+
+def rank_score(r):
+    # Hybridihaussa järjestys tulee RRF-pisteestä, muuten vektorisamankaltaisuudesta
+    return r["rrf_score"] if "rrf_score" in r else r.get("score", 0.0)
+
+def collect_versions(items):
+    # Jos dokumentista löytyy useampi versio (esim. kesken jäänyt synkronointi),
+    # palautetaan ne kaikki, jolloin vertailu välimuistin kanssa epäonnistuu
+    versions = {}
+    for item in items:
+        versions.setdefault(item["parent_doc_id"], set()).add(item["version"])
+    return {
+        doc_id: found.pop() if len(found) == 1 else sorted(found)
+        for doc_id, found in versions.items()
+    }
+
+def build_local_index(items, path=LOCAL_INDEX_PATH):
+    import numpy as np
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    count = 0
+    dim = None
+
+    # Kirjoitetaan rivi kerrallaan, jotta koko kontin vienti ei vaadi matriisia muistiin
+    with open(path / "embeddings.f32", "wb") as vectors, open(path / "metadata.jsonl", "w", encoding="utf-8") as meta:
+        for item in items:
+            vector = np.asarray(item["embedding"], dtype=np.float32)
+            if dim is None:
+                dim = vector.shape[0]
+            vector /= np.linalg.norm(vector)
+            vectors.write(vector.tobytes())
+            meta.write(json.dumps({field: item.get(field) for field in METADATA_FIELDS}, ensure_ascii=False) + "\n")
+            count += 1
+
+    with open(path / "index.json", "w", encoding="utf-8") as f:
+        json.dump({"count": count, "dim": dim or 0}, f)
+    return count
+
+def export_container(container, path=LOCAL_INDEX_PATH):
+    # Paikalliseen indeksiin otsikko ja lähde kirjoitetaan valmiiksi jokaiselle chunkille
+    records = {
+        record["id"]: record
+        for record in container.query_items(
+            query=f"SELECT c.id, {', '.join(f'c.{field}' for field in JOINED_FIELDS)} FROM c WHERE c.type = @type",
+            parameters=[{ "name": "@type", "value": DOCUMENT_TYPE }],
+            enable_cross_partition_query=True
+        )
+    }
+    fields = ", ".join(f"c.{field}" for field in METADATA_FIELDS + ["embedding"])
+    items = container.query_items(
+        query=f"SELECT {fields} FROM c WHERE NOT IS_DEFINED(c.type)",
+        enable_cross_partition_query=True
+    )
+    return build_local_index((join_document(item, records.get(item["parent_doc_id"])) for item in items), path)
+
+def get_retriever(container=None, backend=RETRIEVAL_BACKEND, hybrid=RETRIEVAL_HYBRID, keyword_index=None):
+    if backend == "local":
+        retriever = LocalVectorIndex()
+    elif backend == "cosmos":
+        retriever = CosmosRetriever(container)
+    else:
+        raise ValueError(f"Unknown retrieval backend: {backend}")
+
+    if hybrid:
+        from keyword_index import HybridRetriever, load_index
+
+        retriever = HybridRetriever(retriever, keyword_index or load_index())
+    return retriever
+
+if __name__ == "__main__":
+
+    from cosmosdb import create_cosmos_client
+
+    out_dir = sys.argv[1] if len(sys.argv) > 1 else LOCAL_INDEX_PATH
+
+    cosmos_client = create_cosmos_client()
+    database = cosmos_client.get_database_client(os.getenv("COSMOS_DATABASE"))
+    container = database.get_container_client(os.getenv("COSMOS_CONTAINER"))
+
+    count = export_container(container, out_dir)
+    print(f"Exported {count} chunks to {out_dir}")
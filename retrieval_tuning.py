@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+import numpy as np
+from retrieval import LocalVectorIndex, build_local_index, is_relevant
+from context_packing import count_tokens, format_doc
+from tracing import percentile
+
+# Hakuparametrien viritys golden setin avulla. "record" upottaa dokumentit jokaisella
+# chunkausstrategialla ja golden setin kysymykset ja tallentaa ne snapshotiksi; "sweep"
+# käy snapshotin läpi ilman verkkoyhteyttä ja raportoi recall@k:n ja MRR:n suhteessa
+# hakuviiveeseen ja prompttiin tuleviin tokeneihin sekä tallentaa suositellun toimintapisteen.
+#
+# Golden set (JSONL): {"question": "...", "expected": ["DOC-1_chunk_2", ...]}
+# Käyttö: python retrieval_tuning.py record [--golden golden_set.jsonl] [--docs kansio] [--synthetic N]
+#         python retrieval_tuning.py sweep [--top-k 1,3,5,8] [--thresholds 0.7,0.75,0.8]
+
+GOLDEN_SET_PATH = os.getenv("GOLDEN_SET_PATH", "golden_set.jsonl")
+TUNING_SNAPSHOT_PATH = os.getenv("TUNING_SNAPSHOT_PATH", "tuning_snapshot")
+TUNING_RESULT_PATH = os.getenv("TUNING_RESULT_PATH", "retrieval_tuning.json")
+TOP_K_VALUES = [1, 2, 3, 5, 8]
+THRESHOLD_VALUES = [0.7, 0.75, 0.8, 0.85]
+# Suositus: pienin tokenimäärä niistä pisteistä, joiden recall on enintään tämän verran parhaasta
+RECALL_TOLERANCE = 0.02
+
+def parent_of(chunk_id):
+    return chunk_id.rsplit("_chunk_", 1)[0]
+
+def load_golden_set(path=GOLDEN_SET_PATH):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def synthetic_golden_set(documents, count):
+    # Kysymys on katkelma chunkin lauseesta; odotettu vastaus on sama chunk
+    from cosmosdb import chunk_document, split_into_sentences
+
+    chunks = [chunk for doc in documents for chunk in chunk_document(doc, "auto")]
+    step = max(1, len(chunks) // count)
+    golden = []
+    for chunk in chunks[::step][:count]:
+        words = split_into_sentences(chunk["content"])[0].split()
+        golden.append({"question": " ".join(words[:8]), "expected": [chunk["id"]]})
+    return golden
+
+def record_snapshot(client, documents, golden, strategies, path=TUNING_SNAPSHOT_PATH):
+    from cosmosdb import chunk_document, embed_chunks
+    from document_store import document_record, join_document
+    from embedding_cache import EMBEDDING_MODEL, embed_texts
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    for strategy in strategies:
+        chunks = [
+            join_document(chunk, document_record(doc))
+            for doc in documents
+            for chunk in chunk_document(doc, strategy)
+        ]
+        embed_chunks(client, chunks)
+        count = build_local_index([chunk for chunk in chunks if "embedding" in chunk], path / strategy)
+        print(f"{strategy}: {count} chunks")
+
+    embeddings = embed_texts(client, [entry["question"] for entry in golden])
+    with open(path / "questions.jsonl", "w", encoding="utf-8") as f:
+        for entry, embedding in zip(golden, embeddings):
+            f.write(json.dumps(dict(entry, embedding=embedding), ensure_ascii=False) + "\n")
+    with open(path / "snapshot.json", "w", encoding="utf-8") as f:
+        json.dump({"model": EMBEDDING_MODEL, "strategies": strategies, "questions": len(golden), "created": time.time()}, f)
+
+def evaluate(results, expected, level):
+    # level "chunk" vertaa chunk-id:itä, "doc" lähdedokumentteja (vertailukelpoinen strategioiden välillä)
+    key = (lambda r: r["id"]) if level == "chunk" else (lambda r: r["parent_doc_id"])
+    wanted = set(expected) if level == "chunk" else {parent_of(chunk_id) for chunk_id in expected}
+    found = [key(r) for r in results]
+    hits = wanted.intersection(found)
+    first = next((rank for rank, value in enumerate(found, start=1) if value in wanted), None)
+    return len(hits) / len(wanted), 1 / first if first else 0.0
+
+def sweep(path=TUNING_SNAPSHOT_PATH, top_k_values=TOP_K_VALUES, thresholds=THRESHOLD_VALUES):
+    path = Path(path)
+    with open(path / "snapshot.json", "r", encoding="utf-8") as f:
+        snapshot = json.load(f)
+    with open(path / "questions.jsonl", "r", encoding="utf-8") as f:
+        questions = [json.loads(line) for line in f]
+
+    rows = []
+    for strategy in snapshot["strategies"]:
+        index = LocalVectorIndex(path / strategy)
+        known_ids = {item["id"] for item in index.metadata}
+        for top_k in top_k_values:
+            latencies = []
+            result_lists = []
+            for entry in questions:
+                start = time.perf_counter()
+                result_lists.append(index.search(np.asarray(entry["embedding"], dtype=np.float32), top_k))
+                latencies.append(time.perf_counter() - start)
+
+            for threshold in thresholds:
+                metrics = {"recall_doc": [], "mrr_doc": [], "recall_chunk": [], "mrr_chunk": [], "tokens": []}
+                for entry, results in zip(questions, result_lists):
+                    kept = [r for r in results if is_relevant(r, threshold)]
+                    recall, rr = evaluate(kept, entry["expected"], "doc")
+                    metrics["recall_doc"].append(recall)
+                    metrics["mrr_doc"].append(rr)
+                    # Chunk-tason mittarit vain jos golden setin chunkit ovat tämän strategian indeksissä
+                    if set(entry["expected"]) <= known_ids:
+                        recall, rr = evaluate(kept, entry["expected"], "chunk")
+                        metrics["recall_chunk"].append(recall)
+                        metrics["mrr_chunk"].append(rr)
+                    metrics["tokens"].append(sum(count_tokens(format_doc(r)) for r in kept))
+
+                rows.append({
+                    "strategy": strategy,
+                    "top_k": top_k,
+                    "threshold": threshold,
+                    **{
+                        name: float(np.mean(values)) if values else None
+                        for name, values in metrics.items()
+                    },
+                    "latency_p50_ms": percentile(latencies, 0.5) * 1000,
+                    "latency_p95_ms": percentile(latencies, 0.95) * 1000
+                })
+    return rows
+
+def recommend(rows, tolerance=RECALL_TOLERANCE):
+    best_recall = max(row["recall_doc"] for row in rows)
+    candidates = [row for row in rows if row["recall_doc"] >= best_recall - tolerance]
+    return min(candidates, key=lambda row: (row["tokens"], -row["mrr_doc"], row["latency_p50_ms"]))
+
+def print_rows(rows):
+    print(f"{'strategy':<10} {'k':>3} {'thr':>5} {'recall':>7} {'mrr':>6} {'recall_c':>8} {'tokens':>8} {'p50 ms':>7} {'p95 ms':>7}")
+    for row in rows:
+        recall_chunk = f"{row['recall_chunk']:.3f}" if row["recall_chunk"] is not None else "-"
+        print(
+            f"{row['strategy']:<10} {row['top_k']:>3} {row['threshold']:>5.2f} {row['recall_doc']:>7.3f} "
+            f"{row['mrr_doc']:>6.3f} {recall_chunk:>8} {row['tokens']:>8.0f} "
+            f"{row['latency_p50_ms']:>7.2f} {row['latency_p95_ms']:>7.2f}"
+        )
+
+def parse_list(text, cast):
+    return [cast(value) for value in text.split(",")]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Retrieval tuning: recall@k and MRR vs. latency and tokens")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="embed documents and golden questions into a snapshot")
+    record.add_argument("--golden", default=GOLDEN_SET_PATH)
+    record.add_argument("--docs", default=None, help="document folder (default DOCS_FOLDER)")
+    record.add_argument("--strategies", default="auto,full,paragraph,sentences")
+    record.add_argument("--synthetic", type=int, default=0, help="generate N questions from a synthetic corpus with local fakes")
+
+    run = commands.add_parser("sweep", help="evaluate the snapshot offline")
+    run.add_argument("--top-k", default=",".join(map(str, TOP_K_VALUES)))
+    run.add_argument("--thresholds", default=",".join(map(str, THRESHOLD_VALUES)))
+    run.add_argument("--output", default=TUNING_RESULT_PATH)
+
+    args = parser.parse_args()
+
+    if args.command == "record":
+        strategies = args.strategies.split(",")
+        if args.synthetic:
+            from benchmark import make_corpus
+            from fakes import FakeEmbeddings, FakeOpenAI
+
+            client = FakeOpenAI(FakeEmbeddings(latency_ms=0, per_input_ms=0))
+            documents = make_corpus(max(20, args.synthetic))
+            golden = synthetic_golden_set(documents, args.synthetic)
+        else:
+            from clients import get_openai_client
+            from cosmosdb import folder, list_doc_files, load_documents
+
+            client = get_openai_client()
+            documents = load_documents(list_doc_files(args.docs or folder))
+            golden = load_golden_set(args.golden)
+        record_snapshot(client, documents, golden, strategies)
+        print(f"Snapshot with {len(golden)} questions -> {TUNING_SNAPSHOT_PATH}")
+        sys.exit(0)
+
+    rows = sweep(top_k_values=parse_list(args.top_k, int), thresholds=parse_list(args.thresholds, float))
+    print_rows(rows)
+    best = recommend(rows)
+    print(
+        f"\nRecommended: CHUNK_STRATEGY={best['strategy']} CONTEXT_CANDIDATES={best['top_k']} "
+        f"RELEVANCE_THRESHOLD={best['threshold']} (recall {best['recall_doc']:.3f}, "
+        f"MRR {best['mrr_doc']:.3f}, {best['tokens']:.0f} tokens)"
+    )
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"recommended": best, "rows": rows}, f, indent=2)
+    print(f"Saved to {args.output}")
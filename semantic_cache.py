@@ -0,0 +1,131 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1000"))
+
+class SemanticCache:
+    # Kysymysten upotukset ja valmiit vastaukset. Osuma palautetaan, jos uusi kysymys
+    # on riittävän lähellä tallennettua ja lähdedokumenttien versiot ovat ennallaan
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEMANTIC_CACHE_TTL, max_entries=SEMANTIC_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.next_key = 0
+        self.matrix = None
+        self.matrix_keys = []
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def normalize(self, embedding):
+        import numpy as np
+
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def expire(self):
+        now = time.time()
+        expired = [key for key, entry in self.entries.items() if now - entry["created"] > self.ttl]
+        for key in expired:
+            self.remove(key)
+
+    def remove(self, key):
+        del self.entries[key]
+        self.matrix = None
+
+    def best_match(self, vector, scope):
+        import numpy as np
+
+        if not self.entries:
+            return None, 0.0
+        if self.matrix is None:
+            self.matrix_keys = list(self.entries)
+            self.matrix = np.stack([self.entries[key]["embedding"] for key in self.matrix_keys])
+        scores = self.matrix @ vector
+        # Eri hakurajauksella (esim. yhtiö) tallennettu vastaus ei kelpaa osumaksi
+        for index in np.argsort(-scores):
+            key = self.matrix_keys[index]
+            if self.entries[key]["scope"] == scope:
+                return key, float(scores[index])
+        return None, 0.0
+
+    def lookup(self, embedding, current_versions=None, scope=None):
+        vector = self.normalize(embedding)
+        with self.lock:
+            self.expire()
+            key, score = self.best_match(vector, scope)
+            if key is None or score < self.threshold:
+                self.misses += 1
+                return None
+            entry = self.entries[key]
+
+        # Versiotarkistus tehdään lukon ulkopuolella, koska se voi olla tietokantakysely
+        if current_versions is not None and entry["versions"]:
+            if current_versions(list(entry["versions"])) != entry["versions"]:
+                self.invalidate(key)
+                with self.lock:
+                    self.misses += 1
+                return None
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            self.hits += 1
+        return {
+            "response": entry["response"],
+            "sources": entry["sources"],
+            "similarity": score
+        }
+
+    def store(self, embedding, response, sources, versions, scope=None):
+        with self.lock:
+            key = self.next_key
+            self.next_key += 1
+            self.entries[key] = {
+                "embedding": self.normalize(embedding),
+                "scope": scope,
+                "response": response,
+                "sources": sources,
+                "versions": dict(versions),
+                "created": time.time()
+            }
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.matrix = None
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+
+    def invalidate_document(self, parent_doc_id, version=None):
+        # Poistetaan vastaukset jotka viittaavat dokumenttiin (tai sen muuhun kuin annettuun versioon)
+        with self.lock:
+            stale = [
+                key for key, entry in self.entries.items()
+                if parent_doc_id in entry["versions"]
+                and (version is None or entry["versions"][parent_doc_id] != version)
+            ]
+            for key in stale:
+                self.remove(key)
+        return len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.matrix = None
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0
+            }
@@ -0,0 +1,125 @@
+import os
+import re
+import time
+import threading
+import functools
+import contextvars
+from tracing import record
+
+# Samanaikaiset identtiset pyynnöt (sama kysymys, sama ladattu tiedosto) yhdistetään yhdeksi
+# upstream-suoritukseksi. Suoritus ajetaan taustasäikeessä ja sen tapahtumat jaetaan kaikille
+# odottajille, myös niille jotka liittyvät kesken striimauksen.
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "1") == "1"
+
+def normalize_question(text):
+    # Kirjainkoko, välilyönnit ja loppuvälimerkit eivät muuta kysymystä
+    return re.sub(r"\s+", " ", text).strip().lower().rstrip("?!. ")
+
+class Flight:
+    def __init__(self):
+        self.events = []
+        self.finished = False
+        self.error = None
+        self.waiters = 0
+        self.condition = threading.Condition()
+
+    def publish(self, event):
+        with self.condition:
+            self.events.append(event)
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.finished = True
+            self.error = error
+            self.condition.notify_all()
+
+    def subscribe(self):
+        index = 0
+        while True:
+            with self.condition:
+                while index >= len(self.events) and not self.finished:
+                    self.condition.wait()
+                events = self.events[index:]
+                index += len(events)
+                finished = self.finished and index >= len(self.events)
+            for event in events:
+                yield dict(event)
+            if finished:
+                break
+        if self.error is not None:
+            raise self.error
+
+class SingleFlight:
+    def __init__(self, enabled=SINGLE_FLIGHT_ENABLED):
+        self.enabled = enabled
+        self.flights = {}
+        self.leaders = 0
+        self.followers = 0
+        self.lock = threading.Lock()
+
+    def run(self, key, flight, produce):
+        try:
+            for event in produce():
+                flight.publish(event)
+        except Exception as e:
+            flight.finish(e)
+        else:
+            flight.finish()
+        finally:
+            # Valmistunut suoritus poistetaan heti; myöhemmät pyynnöt osuvat vastausvälimuistiin
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+
+    def stream(self, key, produce):
+        if not self.enabled or key is None:
+            yield from produce()
+            return
+
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self.flights[key] = flight
+                self.leaders += 1
+            else:
+                self.followers += 1
+            flight.waiters += 1
+
+        if leader:
+            # Kontekstin kopio säilyttää istunnon ja tracen taustasäikeessä
+            context = contextvars.copy_context()
+            threading.Thread(target=context.run, args=(self.run, key, flight, produce), daemon=True).start()
+            yield from flight.subscribe()
+            return
+
+        start = time.perf_counter()
+        for event in flight.subscribe():
+            if event["type"] == "done":
+                event["coalesced"] = True
+                record("coalesced", time.perf_counter() - start, request=key[0], waiters=flight.waiters)
+            yield event
+
+    def stats(self):
+        with self.lock:
+            total = self.leaders + self.followers
+            return {
+                "in_flight": len(self.flights),
+                "leaders": self.leaders,
+                "followers": self.followers,
+                "coalesced_ratio": self.followers / total if total else 0.0
+            }
+
+single_flight = SingleFlight()
+
+def coalesced(key_function):
+    # Koristelija striimaaville pyynnöille; key_function palauttaa avaimen tai None jos ei yhdistetä
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = key_function(*args, **kwargs)
+            yield from single_flight.stream(key, lambda: func(*args, **kwargs))
+        return wrapper
+    return decorator
@@ -0,0 +1,50 @@
+import sys
+import subprocess
+
+# Ajaa `python -X importtime -c "import <moduulit>"` erillisessä prosessissa ja
+# listaa hitaimmat tuonnit, jotta kylmäkäynnistyksen kehitystä voi seurata.
+# Käyttö: python startup_report.py [moduuli ...] [--top N]
+
+def measure_imports(modules):
+    code = "; ".join(f"import {module}" for module in modules)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append({
+            "module": name.strip(),
+            "depth": (len(name) - len(name.lstrip())) // 2,
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000
+        })
+    return rows, result.returncode
+
+def print_report(modules, top=20):
+    rows, returncode = measure_imports(modules)
+    if returncode != 0:
+        print(f"Import failed (exit code {returncode})")
+
+    top_level = [row for row in rows if row["depth"] == 0]
+    total_ms = sum(row["cumulative_ms"] for row in top_level)
+    print(f"Total import time for {', '.join(modules)}: {total_ms:.1f} ms ({len(rows)} modules)\n")
+
+    print(f"{'cumulative ms':>14} {'self ms':>10}  module")
+    for row in sorted(rows, key=lambda row: row["cumulative_ms"], reverse=True)[:top]:
+        print(f"{row['cumulative_ms']:>14.1f} {row['self_ms']:>10.1f}  {'  ' * row['depth']}{row['module']}")
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    top = 20
+    if "--top" in args:
+        index = args.index("--top")
+        top = int(args[index + 1])
+        del args[index:index + 2]
+
+    print_report(args or ["chat", "document_check"], top)
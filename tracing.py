@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+import functools
+import contextvars
+from collections import deque
+from contextlib import aclosing, contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Vaihekohtaiset spanit (convert, embed, retrieve, context, generate, ...). Jokainen span
+# kerätään muistiin p50/p95/p99-yhteenvetoja varten, jotka saa Prometheus-tekstimuodossa
+# (python tracing.py --serve tai start_metrics_server). Kun TRACE_PATH on asetettu, spanit
+# kirjoitetaan lisäksi JSONL-tiedostoon, esim. TRACE_PATH=traces.jsonl kuormatestin ajaksi.
+TRACE_PATH = os.getenv("TRACE_PATH", "")
+# Tiedosto kierrätetään (traces.jsonl -> traces.jsonl.1) kun se kasvaa tätä suuremmaksi
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(50 * 1024 * 1024)))
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") == "1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+# Persentiilit lasketaan vaiheen viimeisimmistä spaneista
+TRACE_WINDOW = int(os.getenv("TRACE_WINDOW", "1000"))
+QUANTILES = (0.5, 0.95, 0.99)
+
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+
+def percentile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class Tracer:
+    def __init__(self, path=TRACE_PATH, window=TRACE_WINDOW, enabled=TRACE_ENABLED, max_bytes=TRACE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.window = window
+        self.enabled = enabled
+        self.durations = {}
+        self.counts = {}
+        self.sums = {}
+        self.request_charge = 0.0
+        self.file = None
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds, **attrs):
+        if not self.enabled:
+            return
+        span = {
+            "ts": time.time(),
+            "trace_id": _trace_id.get(),
+            "stage": stage,
+            "seconds": round(seconds, 6),
+            **attrs
+        }
+        line = json.dumps(span, ensure_ascii=False, default=str)
+        with self.lock:
+            self.durations.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+            self.sums[stage] = self.sums.get(stage, 0.0) + seconds
+            self.request_charge += attrs.get("request_charge", 0.0) or 0.0
+            if self.path:
+                if self.file is None:
+                    self.file = open(self.path, "a", encoding="utf-8", buffering=1)
+                self.file.write(line + "\n")
+                if self.max_bytes and self.file.tell() >= self.max_bytes:
+                    self.rotate()
+
+    def rotate(self):
+        # Kutsutaan lukko varattuna; vain yksi edellinen tiedosto säilytetään
+        self.file.close()
+        os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, "a", encoding="utf-8", buffering=1)
+
+    @contextmanager
+    def span(self, stage, **attrs):
+        # Kutsuja voi lisätä attribuutteja (esim. request_charge) palautettuun sanakirjaan
+        start = time.perf_counter()
+        error = None
+        try:
+            yield attrs
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            if error is not None:
+                attrs["error"] = error
+            self.record(stage, time.perf_counter() - start, **attrs)
+
+    def summaries(self):
+        with self.lock:
+            return {
+                stage: {
+                    "count": self.counts[stage],
+                    "sum": self.sums[stage],
+                    **{f"p{round(q * 100)}": percentile(values, q) for q in QUANTILES}
+                }
+                for stage, values in self.durations.items()
+            }
+
+    def prometheus_text(self):
+        lines = [
+            "# HELP rag_stage_seconds Duration of RAG pipeline stages",
+            "# TYPE rag_stage_seconds summary"
+        ]
+        for stage, summary in sorted(self.summaries().items()):
+            for q in QUANTILES:
+                lines.append(f'rag_stage_seconds{{stage="{stage}",quantile="{q}"}} {summary[f"p{round(q * 100)}"]:.6f}')
+            lines.append(f'rag_stage_seconds_sum{{stage="{stage}"}} {summary["sum"]:.6f}')
+            lines.append(f'rag_stage_seconds_count{{stage="{stage}"}} {summary["count"]}')
+        lines += [
+            "# HELP rag_cosmos_request_charge_total Cosmos DB request units consumed by traced queries",
+            "# TYPE rag_cosmos_request_charge_total counter",
+            f"rag_cosmos_request_charge_total {self.request_charge:.2f}"
+        ]
+        return "\n".join(lines) + "\n"
+
+tracer = Tracer()
+
+def span(stage, **attrs):
+    return tracer.span(stage, **attrs)
+
+def record(stage, seconds, **attrs):
+    tracer.record(stage, seconds, **attrs)
+
+@contextmanager
+def trace(name, **attrs):
+    # Yksi pyyntö (esim. chat-kysymys); sen sisällä syntyneet spanit saavat saman trace_id:n
+    previous = _trace_id.get()
+    token = _trace_id.set(uuid.uuid4().hex)
+    try:
+        with tracer.span(name, **attrs) as request_attrs:
+            yield request_attrs
+    finally:
+        try:
+            _trace_id.reset(token)
+        except ValueError:
+            # Asynkroninen generaattori voi sulkeutua eri kontekstissa kuin jossa se aloitettiin
+            _trace_id.set(previous)
+
+def traced_stream(name):
+    # Koristelija striimaaville generaattoreille (stream_chat, stream_doc): koko pyyntö yhtenä tracena
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace(name):
+                yield from func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def traced_astream(name):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            # aclosing sulkee sisemmän generaattorin samassa tehtävässä, kun kuluttaja lopettaa kesken
+            with trace(name):
+                async with aclosing(func(*args, **kwargs)) as events:
+                    async for event in events:
+                        yield event
+        return wrapper
+    return decorator
+
+class GenerationTimer:
+    # Mittaa ensimmäisen tokenin viiveen (ttft) ja koko generoinnin keston
+    def __init__(self, prompt_name):
+        self.prompt_name = prompt_name
+        self.start = time.perf_counter()
+        self.first_token = None
+
+    def delta(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+            record("ttft", self.first_token - self.start, prompt=self.prompt_name)
+
+    def done(self, usage=None):
+        record("generate", time.perf_counter() - self.start, prompt=self.prompt_name, **(usage or {}))
+
+def request_charge_hook(charges):
+    # Cosmos kutsuu koukkua jokaiselle tulossivulle; RU-kulut kerätään listaan
+    def hook(headers, result):
+        charges.append(float(headers.get("x-ms-request-charge", 0)))
+    return hook
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.tracer.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port=METRICS_PORT, source=None):
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    server.tracer = source or tracer
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def load_traces(path=TRACE_PATH):
+    # Lukee JSONL-tiedoston uuteen Traceriin, esim. kuormatestin jälkeistä yhteenvetoa varten
+    offline = Tracer(path=None, window=sys.maxsize, enabled=True)
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            span = json.loads(line)
+            stage = span.pop("stage")
+            seconds = span.pop("seconds")
+            offline.record(stage, seconds, **span)
+    return offline
+
+if __name__ == "__main__":
+
+    args = sys.argv[1:]
+    serve = "--serve" in args
+    args = [arg for arg in args if arg != "--serve"]
+    path = args[0] if args else TRACE_PATH
+    if not path:
+        sys.exit("Usage: python tracing.py <traces.jsonl> [--serve] (or set TRACE_PATH)")
+    offline = load_traces(path)
+
+    print(f"{'stage':<16} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage, summary in sorted(offline.summaries().items()):
+        print(
+            f"{stage:<16} {summary['count']:>7} {summary['p50'] * 1000:>9.1f} "
+            f"{summary['p95'] * 1000:>9.1f} {summary['p99'] * 1000:>9.1f}"
+        )
+    print(f"Cosmos request charge: {offline.request_charge:.1f} RU")
+
+    if serve:
+        start_metrics_server(source=offline)
+        print(f"Serving /metrics on port {METRICS_PORT}, Ctrl+C to stop")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass